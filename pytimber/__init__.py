@@ -10,6 +10,7 @@ from .LHCBWS import BWS
 from . import timberdata
 
 from .pagestore import PageStore
+from .localstats import Stat, StatAccumulator
 
 __version__ = "2.6.2"
 
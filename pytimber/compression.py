@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""In-process codecs for the record files of pages.
+
+Codecs are registered by name, the name is stored in the comp column of
+the pages table. zlib, bz2 and gzip are always available, lzma, zstd and
+lz4 only if the corresponding module is installed.
+"""
+
+import zlib
+import bz2
+
+codecs = {}
+
+
+def register(name, compress, decompress):
+    """Register a codec as a pair of functions bytes->bytes"""
+    codecs[name] = (compress, decompress)
+
+
+def available():
+    return sorted(codecs)
+
+
+def get_codec(name):
+    """Return the compress and decompress functions of codec name"""
+    try:
+        return codecs[name]
+    except KeyError:
+        msg = "Codec %r not available, use one of %s"
+        raise ValueError(msg % (name, ', '.join(available())))
+
+
+def compress(name, data):
+    return get_codec(name)[0](data)
+
+
+def decompress(name, data):
+    return get_codec(name)[1](data)
+
+
+def _gzip_compress(data):
+    obj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return obj.compress(data) + obj.flush()
+
+
+def _gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+register('zlib', zlib.compress, zlib.decompress)
+register('gzip', _gzip_compress, _gzip_decompress)
+register('bz2', bz2.compress, bz2.decompress)
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+if lzma is not None:
+    register('lzma', lzma.compress, lzma.decompress)
+
+try:
+    import zstandard
+    register('zstd', lambda data: zstandard.ZstdCompressor().compress(data),
+             lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    register('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
@@ -10,6 +10,7 @@ except ImportError as e:
   print(e)
 
 from .localdate import parsedate,dumpdate,dumpdateutc
+from .decimate import decimate as decimate_series
 
 def flattenoverlap(v,test=100,start=0):
   #Merge overlapping array of data. Expecting data in axis 1
@@ -275,10 +276,17 @@ class DataQuery(object):
       end  =tbmode[np.where(nbmode==1)[0][:-1]+1]
       print('time window for bm='+bm+'lies partly outside the requested time window')
     return zip(map(dumpdate,start),map(dumpdate,end))
-  def plot_2d(self,vscale='auto',rel_time=False,date_axes=True,timezone='local'):
-    """plot data with date in local time"""
+  def plot_2d(self,vscale='auto',rel_time=False,date_axes=True,timezone='local',
+              decimate=None,decimation='minmax'):
+    """plot data with date in local time
+
+    decimate: if not None, plot at most about *decimate* points per
+              variable, keeping the peaks ('minmax' decimation) or the
+              visually relevant points ('lttb' decimation)"""
     for i,name in enumerate(self.names):
       t,v=self.data[name]
+      if decimate is not None and np.ndim(v)==1:
+        t,v=decimate_series(t,v,decimate,decimation)
       if rel_time==True:
         t=t-t[0]
       if vscale=='auto':
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Reduce time series to a display resolution, keeping peaks and extremes.
+
+minmax: keeps the minimum and the maximum of each time bucket
+lttb: Largest-Triangle-Three-Buckets, keeps the visually relevant points
+
+MinMaxDecimator applies minmax chunk by chunk, so that the full resolution
+data never needs to be in memory at once.
+
+rollup reduces values to [min, max, mean, count] per time bucket, and can be
+applied again to its own output for coarser buckets.
+"""
+
+import numpy as np
+
+
+def _buckets(t, nbuckets, t1, t2):
+    """Return the bucket number of each timestamp for nbuckets equal time
+    buckets between t1 and t2."""
+    if t2 <= t1:
+        return np.zeros(len(t), dtype=int)
+    scale = nbuckets / float(t2 - t1)
+    b = ((np.asarray(t, dtype=float) - t1) * scale).astype(int)
+    return np.clip(b, 0, nbuckets - 1)
+
+
+def _bucket_extrema(b, v):
+    """Return the buckets (not empty and not all NaN) and the indices of the
+    first minimum and first maximum of v in each of them.
+
+    The bucket numbers b must be sorted.
+    """
+    if len(v) == 0:
+        empty = np.array([], dtype=int)
+        return empty, empty, empty
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    seg = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(v)]))
+    out = [b[starts]]
+    valid = None
+    for reduce in (np.fmin, np.fmax):
+        ext = reduce.reduceat(v, starts)
+        cand = np.flatnonzero(v == ext[seg])
+        segs, first = np.unique(seg[cand], return_index=True)
+        out.append(cand[first])
+        valid = segs
+    out[0] = out[0][valid]
+    return tuple(out)
+
+
+def minmax(t, v, npoints, t1=None, t2=None):
+    """Return the sorted indices of the minimum and the maximum of v in
+    npoints/2 equal time buckets between t1 and t2 (by default the first and
+    last timestamps)."""
+    if len(t) <= npoints:
+        return np.arange(len(t))
+    if t1 is None:
+        t1 = t[0]
+    if t2 is None:
+        t2 = t[-1]
+    b = _buckets(t, max(1, npoints // 2), t1, t2)
+    ub, imin, imax = _bucket_extrema(b, np.asarray(v))
+    return np.unique(np.concatenate([imin, imax]))
+
+
+def lttb(t, v, npoints):
+    """Return the sorted indices of the npoints selected by the
+    Largest-Triangle-Three-Buckets algorithm. NaN values are skipped."""
+    n = len(t)
+    if npoints >= n or npoints < 3:
+        return np.arange(n)
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v, dtype=float)
+    good = np.isfinite(v)
+    if not good.all():
+        idx = np.flatnonzero(good)
+        return idx[lttb(t[idx], v[idx], npoints)]
+    edges = np.linspace(1, n - 1, npoints - 1).astype(int)
+    # averages of the next bucket, the last point for the last bucket
+    ct = np.r_[0, np.cumsum(t)]
+    cv = np.r_[0, np.cumsum(v)]
+    lo, hi = edges[1:], np.r_[edges[2:], n]
+    size = (hi - lo).astype(float)
+    nt = (ct[hi] - ct[lo]) / size
+    nv = (cv[hi] - cv[lo]) / size
+    out = np.empty(npoints, dtype=int)
+    out[0] = a = 0
+    out[-1] = n - 1
+    for i in range(npoints - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((t[a] - nt[i]) * (v[lo:hi] - v[a]) -
+                      (t[a] - t[lo:hi]) * (nv[i] - v[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+methods = {'minmax': minmax, 'lttb': lttb}
+
+
+def decimate(t, v, npoints, method='minmax'):
+    """Return (t, v) reduced to about npoints using method ('minmax' or
+    'lttb')."""
+    if len(t) <= npoints:
+        return t, v
+    idx = methods[method](t, v, npoints)
+    return t[idx], v[idx]
+
+
+class MinMaxDecimator(object):
+    """Apply the minmax decimation to data arriving in chunks.
+
+    Example:
+        dec = MinMaxDecimator(t1, t2, 1000)
+        for t, v in chunks:
+            dec.add(t, v)
+        t, v = dec.result()
+    """
+
+    def __init__(self, t1, t2, npoints):
+        self.t1 = t1
+        self.t2 = t2
+        self.nbuckets = max(1, npoints // 2)
+        self.count = np.zeros(self.nbuckets, dtype=int)
+        self.tmin = self.vmin = self.tmax = self.vmax = None
+
+    def add(self, t, v):
+        t = np.asarray(t)
+        v = np.asarray(v)
+        if self.vmin is None:
+            self.tmin = np.zeros(self.nbuckets, dtype=t.dtype)
+            self.tmax = np.zeros(self.nbuckets, dtype=t.dtype)
+            self.vmin = np.zeros(self.nbuckets, dtype=v.dtype)
+            self.vmax = np.zeros(self.nbuckets, dtype=v.dtype)
+        b = _buckets(t, self.nbuckets, self.t1, self.t2)
+        ub, imin, imax = _bucket_extrema(b, v)
+        new = self.count[ub] == 0
+        lower = new | (v[imin] < self.vmin[ub])
+        self.tmin[ub[lower]] = t[imin[lower]]
+        self.vmin[ub[lower]] = v[imin[lower]]
+        upper = new | (v[imax] > self.vmax[ub])
+        self.tmax[ub[upper]] = t[imax[upper]]
+        self.vmax[ub[upper]] = v[imax[upper]]
+        self.count[ub] += 1
+        return self
+
+    def result(self):
+        if self.vmin is None:
+            return np.array([]), np.array([])
+        full = self.count > 0
+        t = np.concatenate([self.tmin[full], self.tmax[full]])
+        v = np.concatenate([self.vmin[full], self.vmax[full]])
+        t, idx = np.unique(t, return_index=True)
+        return t, v[idx]
+
+
+def rollup(t, v, width):
+    """Return the start of the buckets of width containing t and the
+    records [min, max, mean, count] of the finite values of v in each of
+    them.
+
+    v can also be the records of a rollup with a width dividing width. t
+    must be sorted.
+    """
+    v = np.asarray(v, dtype=float)
+    t = np.asarray(t)
+    if len(t) == 0:
+        return t, np.zeros((0, 4))
+    if v.ndim == 1:
+        good = np.isfinite(v)
+        vmin = vmax = mean = np.where(good, v, np.nan)
+        count = good.astype(float)
+    else:
+        vmin, vmax, mean, count = v.T
+    buckets = t // width * width
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    out = np.empty((len(starts), 4))
+    out[:, 0] = np.fmin.reduceat(vmin, starts)
+    out[:, 1] = np.fmax.reduceat(vmax, starts)
+    out[:, 3] = np.add.reduceat(count, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.add.reduceat(np.where(count > 0, mean * count, 0), starts)
+        out[:, 2] = total / out[:, 3]
+    return buckets[starts], out
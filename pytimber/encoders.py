@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Vectorized encodings for the index and record files of pages.
+
+dod: delta-of-delta of the integer view of the index, stored as zigzag
+     varints. Regularly sampled timestamps, integer or float, take about one
+     byte per sample.
+xor: Gorilla-style XOR of consecutive floats, byte-granular: a header byte
+     with the number of leading and trailing zero bytes of each XOR, then
+     the remaining bytes.
+
+The encoding of a page is stored as 'idxencoding,recencoding', with an
+empty string for data stored raw.
+"""
+
+import numpy as np
+
+
+def split_encoding(encoding):
+    """Return the encodings of index and records of 'idx,rec'"""
+    if not encoding:
+        return None, None
+    idxenc, recenc = (encoding.split(',') + [''])[:2]
+    return idxenc or None, recenc or None
+
+
+def join_encoding(idxenc, recenc):
+    if idxenc is None and recenc is None:
+        return None
+    return '%s,%s' % (idxenc or '', recenc or '')
+
+
+def _int_view(data):
+    """Return the integers with the bit patterns of data as uint64"""
+    data = np.ascontiguousarray(data)
+    itype = np.dtype('<i%d' % data.dtype.itemsize)
+    return data.view(itype).astype(np.int64).view(np.uint64)
+
+
+def zigzag(data):
+    data = data.view(np.int64)
+    out = data << 1
+    out ^= data >> 63
+    return out.view(np.uint64)
+
+
+def unzigzag(data):
+    out = (data >> np.uint64(1)).view(np.int64)
+    out ^= -(data & np.uint64(1)).view(np.int64)
+    return out
+
+
+def varint_encode(data):
+    """Encode uint64 data as little-endian base-128 varints"""
+    data = np.asarray(data, dtype=np.uint64)
+    if len(data) == 0:
+        return b''
+    top = int(data.max())
+    nmax = 1
+    while nmax < 10 and top >= 1 << (7 * nmax):
+        nmax += 1
+    if nmax == 1:
+        return data.astype(np.uint8).tobytes()
+    nbytes = np.ones(len(data), dtype=np.int64)
+    for k in range(1, nmax):
+        nbytes += data >= np.uint64(1 << (7 * k))
+    ends = np.cumsum(nbytes)
+    starts = ends - nbytes
+    out = np.empty(ends[-1], dtype=np.uint8)
+    sel = np.arange(len(data))
+    for k in range(nmax):
+        if k > 0:
+            sel = sel[nbytes[sel] > k]
+        byte = ((data[sel] >> np.uint64(7 * k)) & np.uint64(0x7f))
+        byte = byte.astype(np.uint8)
+        byte[nbytes[sel] > k + 1] |= 0x80
+        out[starts[sel] + k] = byte
+    return out.tobytes()
+
+
+def varint_decode(data, count):
+    """Decode count uint64 varints"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if count == 0:
+        return np.array([], dtype=np.uint64)
+    last = data < 0x80
+    if last[:count].all():
+        return data[:count].astype(np.uint64)
+    ends = np.flatnonzero(last)[:count]
+    if len(ends) != count:
+        raise IOError("Truncated varint data: %d of %d" % (len(ends), count))
+    data = data[:ends[-1] + 1]
+    starts = np.r_[0, ends[:-1] + 1]
+    group = np.cumsum(np.r_[False, last[:len(data) - 1]])
+    shift = (np.arange(len(data)) - starts[group]) * 7
+    value = (data & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(value, starts)
+
+
+def encode_dod(data):
+    """Return the first two values raw and the zigzag varints of the
+    second differences"""
+    x = _int_view(data)
+    return x[:2].tobytes() + varint_encode(zigzag(np.diff(x, 2)))
+
+
+def decode_dod(data, dtype, count):
+    dtype = np.dtype(dtype)
+    nhead = min(count, 2)
+    d2 = np.empty(count, dtype=np.uint64)
+    d2[:nhead] = np.frombuffer(data[:8 * nhead], dtype=np.uint64)
+    if count > 1:
+        d2[1:2] -= d2[0:1] * np.uint64(2)
+    if count > 2:
+        d2[2:] = unzigzag(varint_decode(data[16:], count - 2))
+    x = np.cumsum(np.cumsum(d2, dtype=np.uint64), dtype=np.uint64)
+    itype = '<i%d' % dtype.itemsize
+    return x.view(np.int64).astype(itype).view(dtype)
+
+
+def _keep_table(size):
+    """Masks of the bytes kept for each header byte lead<<4|trail"""
+    header = np.arange(256)
+    col = np.arange(size)
+    return ((col >= (header & 0xf)[:, None]) &
+            (col < size - (header >> 4)[:, None]))
+
+
+_keep = dict((size, _keep_table(size)) for size in (4, 8))
+
+
+def encode_xor(data):
+    data = np.ascontiguousarray(data)
+    size = data.dtype.itemsize
+    utype = np.dtype('<u%d' % size)
+    x = data.view(utype)
+    x = x ^ np.r_[np.zeros(1, dtype=utype), x[:-1]]
+    low = x & (~x + utype.type(1))
+    lead = np.zeros(len(x), dtype=np.uint8)
+    trail = np.zeros(len(x), dtype=np.uint8)
+    for k in range(1, size + 1):
+        lead += x < utype.type(1 << (8 * (size - k)))
+    for k in range(1, size):
+        trail += low >= utype.type(1 << (8 * k))
+    header = (lead << 4) | trail
+    keep = _keep[size][header]
+    payload = x.view(np.uint8).reshape(-1, size)[keep]
+    return header.tobytes() + payload.tobytes()
+
+
+def decode_xor(data, dtype, count):
+    dtype = np.dtype(dtype)
+    size = dtype.itemsize
+    data = np.frombuffer(data, dtype=np.uint8)
+    keep = _keep[size][data[:count]]
+    payload = data[count:]
+    nkeep = np.count_nonzero(keep)
+    if nkeep != len(payload):
+        raise IOError("Wrong xor payload %d!=%d" % (len(payload), nkeep))
+    nbytes = np.zeros((count, size), dtype=np.uint8)
+    nbytes[keep] = payload
+    x = np.bitwise_xor.accumulate(nbytes.view('<u%d' % size).ravel())
+    return x.view(dtype)
+
+
+def can_encode_dod(dtype):
+    dtype = np.dtype(dtype)
+    return dtype.kind in 'iuf' and dtype.itemsize in (1, 2, 4, 8)
+
+
+def can_encode_xor(dtype):
+    dtype = np.dtype(dtype)
+    return dtype.kind == 'f' and dtype.itemsize in (4, 8)
+
+
+idx_encoders = {'dod': (can_encode_dod, encode_dod, decode_dod)}
+rec_encoders = {'xor': (can_encode_xor, encode_xor, decode_xor)}
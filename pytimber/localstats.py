@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Statistics of local data with the same fields as LoggingDB.getStats.
+
+StatAccumulator keeps count, mean and sum of squared deviations, which can
+be merged without loss of precision, so that the statistics of a long window
+can be combined from the statistics of chunks or pages.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+Stat = namedtuple(
+    'Stat',
+    ['MinTstamp', 'MaxTstamp', 'ValueCount',
+     'MinValue', 'MaxValue', 'AvgValue',
+     'StandardDeviationValue']
+)
+
+
+class StatAccumulator(object):
+    """Mergeable accumulator of the Stat fields.
+
+    Example:
+        acc = StatAccumulator()
+        for idx, rec in chunks:
+            acc.add(idx, rec)
+        stat = acc.stat()
+    """
+
+    def __init__(self, count=0, mean=0., m2=0., vmin=np.inf, vmax=-np.inf,
+                 tmin=None, tmax=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.vmin = vmin
+        self.vmax = vmax
+        self.tmin = tmin
+        self.tmax = tmax
+
+    def add(self, idx, rec):
+        """Add records rec with timestamps idx. NaN values are ignored,
+        vector records contribute all their elements."""
+        rec = np.asarray(rec, dtype=float)
+        good = np.isfinite(rec)
+        if rec.ndim > 1:
+            good = good.reshape(len(rec), -1)
+            rows = good.any(axis=1)
+        else:
+            rows = good
+        values = rec.reshape(good.shape)[good]
+        if len(values) == 0:
+            return self
+        idx = np.asarray(idx)[rows]
+        mean = values.mean()
+        other = StatAccumulator(len(values), mean,
+                                ((values - mean) ** 2).sum(),
+                                values.min(), values.max(), idx[0], idx[-1])
+        return self.merge(other)
+
+    def merge(self, other):
+        """Merge the statistics of other into self"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / float(count)
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / \
+            float(count)
+        self.count = count
+        self.vmin = min(self.vmin, other.vmin)
+        self.vmax = max(self.vmax, other.vmax)
+        self.tmin = min(self.tmin, other.tmin)
+        self.tmax = max(self.tmax, other.tmax)
+        return self
+
+    def stat(self, ddof=1):
+        """Return the Stat of the accumulated values or None if empty.
+        The standard deviation uses count-ddof degrees of freedom."""
+        if self.count == 0:
+            return None
+        if self.count > ddof:
+            std = np.sqrt(self.m2 / (self.count - ddof))
+        else:
+            std = 0.
+        return Stat(self.tmin, self.tmax, int(self.count),
+                    float(self.vmin), float(self.vmax), float(self.mean),
+                    float(std))
+
+
+def getStats(data, ddof=1):
+    """Return {variable: Stat} of data as returned by LoggingDB.get or
+    PageStore.get, skipping variables without numeric values."""
+    out = {}
+    for name, (idx, rec) in data.items():
+        try:
+            stat = StatAccumulator().add(idx, rec).stat(ddof)
+        except (TypeError, ValueError):
+            continue
+        if stat is not None:
+            out[name] = stat
+    return out
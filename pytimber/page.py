@@ -1,23 +1,33 @@
-import os,time,gzip
+import os,time
 import hashlib
 
 import numpy as np
 
 import sys
 
+from . import compression
+from . import encoders
+from .localstats import StatAccumulator
+
+# os.rename does not overwrite existing files on Windows
+replace=getattr(os,'replace',os.rename)
+
 def id_to_path(num,nchar=3):
     sss=str(num)[::-1]
     sss=[sss[i:i+nchar][::-1] for i in range(0,len(sss),nchar)][::-1]
     sss=['0'+a for a in sss[:-1]]+sss[-1:]
     return os.path.join(*sss)
 
-def hashfile(sha,fpath,BUF_SIZE = 65536):
+def hashfile(sha,fpath,size=-1,BUF_SIZE = 65536):
+    """Update sha with the first size bytes (all if -1) of fpath"""
     with open(fpath, 'rb') as f:
-      while True:
-        data = f.read(BUF_SIZE)
+      while size!=0:
+        data = f.read(BUF_SIZE if size<0 else min(size,BUF_SIZE))
         if not data:
           break
         sha.update(data)
+        if size>0:
+          size-=len(data)
     return sha
 
 def split_string_utf32(sss):
@@ -28,10 +38,60 @@ def split_string(sss):
   sss=[a for a in sss.split('\0') if len(a)>0]
   return sss
 
+def read_range(fname,dtype,start,count,offset=0):
+    """Read count items of dtype starting from item start of the data
+    at byte offset"""
+    dtype=np.dtype(dtype)
+    with open(fname,'rb') as fh:
+      fh.seek(offset+start*dtype.itemsize)
+      return np.fromfile(fh,dtype=dtype,count=count)
+
+def read_bytes(fname,offset=0,size=-1):
+    """Read size bytes (all if -1) from byte offset of fname"""
+    with open(fname,'rb') as fh:
+      if size>=0 and hasattr(os,'pread'):
+        return os.pread(fh.fileno(),size,offset)
+      fh.seek(offset)
+      return fh.read(size)
+
+def write_atomic(fname,data):
+    """Write data to a temporary file renamed to fname, so that readers
+    never see a partially written file"""
+    tmp='%s.%d.tmp'%(fname,os.getpid())
+    with open(tmp,'wb') as fh:
+      fh.write(data)
+    replace(tmp,fname)
+
+def summarize(values):
+    """Return vmin,vmax,vsum,vm2,nancount of the finite values, vm2 being
+    the sum of squared deviations from the mean, nancount the number of
+    values not finite. All None if values are not numbers."""
+    values=np.asarray(values)
+    if values.dtype.kind not in 'iuf':
+        return None,None,None,None,None
+    values=values.ravel().astype(float)
+    good=np.isfinite(values)
+    nancount=len(values)-int(np.count_nonzero(good))
+    if nancount>0:
+        values=values[good]
+    if len(values)==0:
+        return None,None,0.,0.,nancount
+    vsum=float(values.sum())
+    mean=vsum/len(values)
+    vm2=float(np.dot(values-mean,values-mean))
+    return float(values.min()),float(values.max()),vsum,vm2,nancount
+
+def segment_path(pagedir,segment):
+    return os.path.join(pagedir,'segments','%08d.seg'%segment)
+
 class Page(object):
     def __init__(self,pagedir,pageid,
                       idxtype,count,idxa,idxb,
-                      rectype,reclen,recsize,comp,checksum,check=False):
+                      rectype,reclen,recsize,comp,checksum,encoding=None,
+                      disksize=None,segment=None,segoffset=None,
+                      idxbytes=None,lenbytes=None,
+                      vmin=None,vmax=None,vsum=None,vm2=None,nancount=None,
+                      check=False):
        self.pageid=pageid
        self.pagedir=pagedir
        self.rectype=rectype
@@ -43,16 +103,40 @@ class Page(object):
        self.recsize=recsize
        self.comp=comp
        self.checksum=checksum
+       self.encoding=encoding
+       self.idxenc,self.recenc=encoders.split_encoding(encoding)
+       self.disksize=disksize
+       # pages packed in a segment file: data at segoffset, as the index,
+       # lengths and records parts of idxbytes, lenbytes and the rest
+       self.segment=segment
+       self.segoffset=segoffset
+       self.idxbytes=idxbytes
+       self.lenbytes=lenbytes
+       if segment is not None:
+         self.segpath=segment_path(pagedir,segment)
+       # summary of the values, nancount is None if not available
+       self.vmin=vmin
+       self.vmax=vmax
+       self.vsum=vsum
+       self.vm2=vm2
+       self.nancount=nancount
        base=os.path.join(pagedir,id_to_path(self.pageid))
        self.pagepath=os.path.split(base)[0]
        self.recpath=os.path.join(base+'.rec')
+       if comp=='gzip':
+         self.recfile=self.recpath+'.gz'
+       else:
+         self.recfile=self.recpath
        self.idxpath=os.path.join(base+'.idx')
        if self.reclen == -1:
          self.lenpath=os.path.join(base+'.len')
        if check and self.checksum is not None:
          assert self.check()
     @classmethod
-    def from_data(cls,idx,rec,pagedir,pageid,comp=None):
+    def from_data(cls,idx,rec,pagedir,pageid,comp=None,encoding=None,
+                  append_segment=None):
+       """Write a new page. If append_segment is given, the page data is
+       passed to append_segment(data) which returns segment,segoffset"""
        count=len(idx)
        if count==0 or len(rec)!=count:
           msg="Error creating Page %s: idx,rec length mismatch %d!=%d"
@@ -91,53 +175,84 @@ class Page(object):
               reclen=rec.shape[1]
        idx=np.array(idx)
        idxtype=idx.dtype.str
-       self=cls(pagedir,pageid,idxtype,count,idx[0],idx[-1],
-                        rectype,reclen,int(recsize),comp,None)
-       if not os.path.isdir(self.pagepath):
-         os.makedirs(self.pagepath)
-       idx.tofile(self.idxpath)
-       sha = hashlib.md5()
-       sha=hashfile(sha,self.idxpath)
+       # encodings not applicable to the data are dropped
+       idxenc,recenc=encoders.split_encoding(encoding)
+       if idxenc is not None:
+         if not encoders.idx_encoders[idxenc][0](idx.dtype):
+           idxenc=None
+       if recenc is not None:
+         if reclen==-1 or recsize==0 or \
+            not encoders.rec_encoders[recenc][0](rec.dtype):
+           recenc=None
+       encoding=encoders.join_encoding(idxenc,recenc)
        if reclen==-1:
-          recfh=open(self.recpath,'wb')
-          lengths.tofile(self.lenpath)
-          sha=hashfile(sha,self.lenpath)
-          [ rrr.tofile(recfh) for rrr in rec]
-          recfh.close()
+         summary=summarize(np.concatenate(rec))
        else:
-          if recsize>0:
-            rec.tofile(self.recpath)
+         summary=summarize(rec)
+       self=cls(pagedir,pageid,idxtype,count,idx[0].item(),idx[-1].item(),
+                        rectype,reclen,int(recsize),comp,None,encoding,
+                        None,None,None,None,None,*summary)
+       sha = hashlib.md5()
+       if idxenc is None:
+         idxdata=idx.tobytes()
+       else:
+         idxdata=encoders.idx_encoders[idxenc][1](idx)
+       sha.update(idxdata)
+       lendata=b''
+       if reclen==-1:
+          lendata=lengths.tobytes()
+          sha.update(lendata)
+       recdata=b''
        if recsize>0:
-         sha=hashfile(sha,self.recpath)
-         if comp=='gzip':
-            os.system("gzip %s"%self.recpath)
+         # checksum of the uncompressed data
+         if recenc is not None:
+           # vectors are encoded along time
+           recdata=encoders.rec_encoders[recenc][1](rec.T.ravel())
+         elif reclen==-1:
+           recdata=b''.join([rrr.tobytes() for rrr in rec])
+         else:
+           recdata=rec.tobytes()
+         sha.update(recdata)
+         if comp is not None:
+           recdata=compression.compress(comp,recdata)
          self.checksum=sha.hexdigest()
+       if append_segment is None:
+         if not os.path.isdir(self.pagepath):
+           os.makedirs(self.pagepath)
+         for fname,data in [(self.idxpath,idxdata),
+                            (reclen==-1 and self.lenpath,lendata),
+                            (recsize>0 and self.recfile,recdata)]:
+           if fname:
+             write_atomic(fname,data)
+       else:
+         self.segment,self.segoffset=append_segment(idxdata+lendata+recdata)
+         self.segpath=segment_path(pagedir,self.segment)
+         self.idxbytes=len(idxdata)
+         self.lenbytes=len(lendata)
+       self.disksize=len(idxdata)+len(lendata)+len(recdata)
        return self
+    def _files(self):
+        if self.segment is not None:
+          return []
+        files=[self.idxpath,self.recfile]
+        if self.reclen==-1:
+          files.append(self.lenpath)
+        return [fname for fname in files if os.path.exists(fname)]
     def get_all(self):
         return self.get_idx_all(),self.get_rec_all()
     def get_rec_all(self):
         if self.recsize==0:
             rec=np.array([[]]*self.count,dtype=self.rectype)
         else:
-            if self.comp=='gzip':
-                os.system("gunzip %s.gz"%self.recpath)
             cc=self.count
             reclen=self.reclen
             if reclen==-1:
-                lengths=np.fromfile(self.lenpath,dtype='<i8',count=cc)
-                recfh=open(self.recpath)
-                rec=[np.fromfile(recfh,dtype=self.rectype,count=cc)
-                                                      for cc in lengths]
-                recfh.close()
-                if 'S' in self.rectype:
-                    rec=[split_string(rrr.tostring()) for rrr in rec]
-                elif 'U' in self.rectype:
-                    rec=[split_string_utf32(rrr.tostring()) for rrr in rec]
+                lengths=self._read_items('len','<i8',0,cc)
+                rec=self._read_varlen(0,lengths)
             elif reclen==0:
-                rec=np.fromfile(self.recpath,dtype=self.rectype,count=cc)
+                rec=self._read_rec(0,cc)
             else:
-                rec=np.fromfile(self.recpath,dtype=self.rectype,
-                        count=cc*reclen)
+                rec=self._read_rec(0,cc*reclen)
                 if len(rec)<cc*reclen:
                     msg="Error in Page %s: not enough records:%d!=%d*%d"
                     raise IOError(msg%(self.pageid,cc*reclen,cc,reclen))
@@ -146,59 +261,251 @@ class Page(object):
                 msg='Error: Record mismatch in Page %d: %d read vs %d'
                 raise IOError(msg%(self.pageid,len(rec),self.count))
         return rec
+    def _read_varlen(self,start,lengths):
+        if len(lengths)==0:
+            return []
+        total=int(lengths.sum())
+        data=self._read_rec(start,total)
+        if len(data)!=total:
+            msg="Error in Page %s: not enough records:%d!=%d"
+            raise IOError(msg%(self.pageid,len(data),total))
+        rec=np.split(data,np.cumsum(lengths)[:-1])
+        if 'S' in self.rectype:
+            rec=[split_string(rrr.tobytes()) for rrr in rec]
+        elif 'U' in self.rectype:
+            rec=[split_string_utf32(rrr.tobytes()) for rrr in rec]
+        return rec
+    def _recfile(self):
+        """Return the path and the codec of the record file"""
+        if self.segment is not None:
+            return self.segpath,self.comp
+        if self.comp=='gzip' and not os.path.exists(self.recfile):
+            # decompressed in place by older versions
+            return self.recpath,None
+        return self.recfile,self.comp
+    def _locate(self,part):
+        """Return the file, the byte offset and the size in bytes (-1 for
+        the whole file) of part 'idx', 'len' or 'rec'"""
+        if self.segment is None:
+            if part=='idx':
+                return self.idxpath,0,-1
+            elif part=='len':
+                return self.lenpath,0,-1
+            return self._recfile()[0],0,-1
+        offset=self.segoffset
+        if part=='idx':
+            return self.segpath,offset,self.idxbytes
+        offset+=self.idxbytes
+        if part=='len':
+            return self.segpath,offset,self.lenbytes
+        offset+=self.lenbytes
+        return self.segpath,offset,self.disksize-self.idxbytes-self.lenbytes
+    def _read_part(self,part):
+        return read_bytes(*self._locate(part))
+    def _read_items(self,part,dtype,start,count):
+        """Read count items of dtype from item start of part"""
+        fname,offset,size=self._locate(part)
+        if size>=0:
+            # do not read into the next page of the segment
+            count=max(0,min(count,size//np.dtype(dtype).itemsize-start))
+        return read_range(fname,dtype,start,count,offset)
+    def _memmap(self,part,dtype):
+        fname,offset,size=self._locate(part)
+        return np.memmap(fname,dtype=dtype,mode='r',offset=offset,
+                         shape=(self.count,))
+    def _read_rec(self,start,count):
+        """Read count items from item start of the record file,
+        decompressing and decoding it in memory"""
+        comp=self._recfile()[1]
+        if comp is None and self.recenc is None:
+            return self._read_items('rec',self.rectype,start,count)
+        data=self._read_part('rec')
+        if comp is not None:
+            data=compression.decompress(comp,data)
+        if self.recenc is not None:
+            size=max(self.reclen,1)
+            decode=encoders.rec_encoders[self.recenc][2]
+            rec=decode(data,self.rectype,self.count*size)
+            if self.reclen>0:
+                rec=rec.reshape(self.reclen,self.count).T.ravel()
+            return rec[start:start+count]
+        itemsize=np.dtype(self.rectype).itemsize
+        count=max(0,min(count,len(data)//itemsize-start))
+        return np.frombuffer(data,dtype=self.rectype,count=count,
+                             offset=start*itemsize)
+    def get_rec_range(self,a,b):
+        """Read only the records from a to b (excluded)"""
+        if self.recsize==0:
+            return self.get_rec_all()[a:b]
+        if self.reclen==-1:
+            lengths=self._memmap('len','<i8')
+            start=int(lengths[:a].sum())
+            lengths=np.array(lengths[a:b])
+            return self._read_varlen(start,lengths)
+        size=max(self.reclen,1)
+        rec=self._read_rec(a*size,(b-a)*size)
+        if len(rec)!=(b-a)*size:
+            msg="Error in Page %s: not enough records:%d!=%d*%d"
+            raise IOError(msg%(self.pageid,len(rec),b-a,size))
+        if self.reclen>0:
+            rec=rec.reshape(b-a,self.reclen)
+        return rec
+    def get_idx_range(self,a,b):
+        """Read only the index from a to b (excluded)"""
+        if self.idxenc is not None:
+            return self.get_idx_all()[a:b]
+        return self._read_items('idx',self.idxtype,a,b-a)
     def get_idx_all(self):
         cc=self.count
-        idx=np.fromfile(self.idxpath,dtype=self.idxtype,count=cc)
+        if self.idxenc is not None:
+            data=self._read_part('idx')
+            decode=encoders.idx_encoders[self.idxenc][2]
+            idx=decode(data,self.idxtype,cc)
+        else:
+            idx=self._read_items('idx',self.idxtype,0,cc)
         if len(idx)!=cc:
             msg='Error: Index mismatch in Page %d: %d read vs %d'
             raise IOError(msg%(self.pageid,len(idx),cc))
         return idx
     def delete(self):
-        os.unlink(self.recpath)
+        if self.segment is not None:
+            # the space is reclaimed when compacting the segments
+            return
+        for fname in (self.recfile,self.recpath):
+            if os.path.exists(fname):
+                os.unlink(fname)
         os.unlink(self.idxpath)
         if self.reclen==-1:
             os.unlink(self.lenpath)
     def _tolist(self):
-        timestamp=os.path.getmtime(self.idxpath)
+        if self.segment is None:
+          timestamp=os.path.getmtime(self.idxpath)
+        else:
+          timestamp=time.time()
         return [self.pageid,self.idxtype,self.count,self.idxa,self.idxb,
                self.rectype,self.reclen,self.recsize,self.comp,
-               timestamp,self.checksum]
+               timestamp,self.checksum,self.encoding,self.disksize,
+               self.segment,self.segoffset,self.idxbytes,self.lenbytes,
+               self.vmin,self.vmax,self.vsum,self.vm2,self.nancount]
+    def get_summary(self):
+        """Return a StatAccumulator of the values from the stored summary,
+        None if not available or if not all values are finite, as the
+        times of the first and last values are then unknown"""
+        if self.nancount!=0:
+            return None
+        nvalues=self.recsize//np.dtype(self.rectype).itemsize
+        if nvalues==0:
+            return StatAccumulator()
+        return StatAccumulator(nvalues,self.vsum/nvalues,self.vm2,
+                               self.vmin,self.vmax,self.idxa,self.idxb)
     def get(self,idxa,idxb,skip=1):
-        idx,rec=self.get_all()
-        a=idx.searchsorted(idxa,side='left')
-        b=idx.searchsorted(idxb,side='right')
-        return idx[a:b:skip],rec[a:b:skip]
+        a,b=self.get_range(idxa,idxb)
+        return self.get_idx_range(a,b)[::skip],self.get_rec_range(a,b)[::skip]
     def get_idx(self,idxa,idxb,skip=1):
-        idx=self.get_idx_all()
-        a=idx.searchsorted(idxa,side='left')
-        b=idx.searchsorted(idxb,side='right')
-        return idx[a:b:skip]
+        a,b=self.get_range(idxa,idxb)
+        return self.get_idx_range(a,b)[::skip]
     def get_range(self,idxa,idxb):
-        a=idx.searchsorted(idxa,side='left')
-        b=idx.searchsorted(idxb,side='right')
+        """Return the positions of the records between idxa and idxb,
+        searching a memory map of the index file"""
+        if self.idxenc is not None:
+            idx=self.get_idx_all()
+        else:
+            idx=self._memmap('idx',self.idxtype)
+        a=int(idx.searchsorted(idxa,side='left'))
+        b=int(idx.searchsorted(idxb,side='right'))
+        del idx
         return a,b
     def get_count(self,idxa,idxb,skip=1):
-        return len(self.get_idx(idxa,idxb,skip=skip))
+        a,b=self.get_range(idxa,idxb)
+        return len(range(a,b,skip))
     def get_recsize(self,idxa,idxb,skip=1):
         if self.reclen>=0:
             itemsize=self.recsize/self.count
-            return self.count(idxa,idxb,skip=skip)*itemsize
+            return self.get_count(idxa,idxb,skip=skip)*itemsize
         else:
            a,b=self.get_range(idxa,idxb)
-           items=np.sum(np.fromfile(self.lenpath,
-                                     dtype='<i8',count=cc)[a:b:skip])
+           items=np.sum(self._read_items('len','<i8',0,self.count)[a:b:skip])
            return items*np.dtype(self.rectype).itemsize
-    def check(self):
+    def append(self,idx,rec,checksum=False):
+        """Append idx,rec at the end of the page files in place. Return
+        False if the page cannot be extended (compressed, encoded, variable
+        length or incompatible types). The checksum is recomputed if
+        checksum is True else removed."""
+        if self.comp is not None or self.encoding is not None or \
+           self.reclen==-1 or self.recsize==0 or self.segment is not None:
+            return False
+        idx=np.asarray(idx)
+        try:
+            rec=np.asarray(rec)
+        except ValueError:
+            # variable length records
+            return False
+        if rec.dtype==object or rec.ndim!=(2 if self.reclen>0 else 1):
+            return False
+        if self.reclen>0 and rec.shape[1]!=self.reclen:
+            return False
+        if not (np.can_cast(idx.dtype,self.idxtype) and
+                np.can_cast(rec.dtype,self.rectype)):
+            return False
+        idx=idx.astype(self.idxtype)
+        rec=rec.astype(self.rectype)
+        # write after the known records, dropping leftovers of failed writes
+        for fname,data,size in [(self.idxpath,idx,self.count*idx.itemsize),
+                                (self.recpath,rec,self.recsize)]:
+            with open(fname,'r+b') as fh:
+                fh.seek(size)
+                data.tofile(fh)
+                fh.truncate()
+        if self.nancount is not None:
+            self._update_summary(rec)
+        self.count+=len(idx)
+        self.idxb=idx[-1].item()
+        self.recsize+=rec.nbytes
+        self.checksum=self._hash() if checksum else None
+        self.disksize=sum(os.path.getsize(fname) for fname in self._files())
+        return True
+    def _update_summary(self,rec):
+        vmin,vmax,vsum,vm2,nancount=summarize(rec)
+        nold=self.recsize//rec.itemsize-self.nancount
+        nnew=rec.size-nancount
+        if nnew>0:
+            old=StatAccumulator()
+            if nold>0:
+                old=StatAccumulator(nold,self.vsum/nold,self.vm2,
+                                    self.vmin,self.vmax,0,0)
+            new=StatAccumulator(nnew,vsum/nnew,vm2,vmin,vmax,0,0)
+            old.merge(new)
+            self.vmin=float(old.vmin)
+            self.vmax=float(old.vmax)
+            self.vsum=old.mean*old.count
+            self.vm2=old.m2
+        self.nancount+=nancount
+    def _hash(self):
         sha=hashlib.md5()
-        sha=hashfile(sha,self.idxpath)
+        parts=['idx']
         if self.reclen==-1:
-          sha=hashfile(sha,self.lenpath)
-        if self.comp=='gzip':
-          sha=hashfile(sha,self.recpath+'.gz')
-        else:
-          sha=hashfile(sha,self.recpath)
-        res=sha.hexdigest()==self.checksum
+          parts.append('len')
+        if self.recsize>0:
+          parts.append('rec')
+        for part in parts:
+          fname,offset,size=self._locate(part)
+          comp=self._recfile()[1] if part=='rec' else None
+          if comp is None and size<0:
+            # only the first count records, others may be appended in place
+            if part=='idx' and self.idxenc is None:
+              size=self.count*np.dtype(self.idxtype).itemsize
+            elif part=='rec' and self.recenc is None:
+              size=self.recsize
+            sha=hashfile(sha,fname,size)
+          else:
+            data=read_bytes(fname,offset,size)
+            if comp is not None:
+              data=compression.decompress(comp,data)
+            sha.update(data)
+        return sha.hexdigest()
+    def check(self):
+        res=self._hash()==self.checksum
         if res==False:
-            print("Checksum failsed for page %s"%self.pageid)
+            print("Checksum failed for page %s"%self.pageid)
         return res
 
@@ -1,12 +1,27 @@
-import os,sys,shutil,tempfile
+import os,sys,shutil,tempfile,time,errno,random
+import operator
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import sqlite3
+import warnings
 import numpy as np
 
-from .page import Page
+from .page import Page, segment_path, read_bytes
+from .localstats import StatAccumulator
+from . import compression
+from . import encoders
+from .decimate import rollup
 
 
 
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
 try:
     isinstance("", basestring)
     def isstr(s):
@@ -16,18 +31,161 @@ except NameError:
         return isinstance(s, str)
 
 
+def is_locked(error):
+    """True if a sqlite error is due to a lock held by another connection"""
+    msg=str(error)
+    return 'locked' in msg or 'busy' in msg
+
+
+def read_transaction(method):
+    """Run a read of PageStore in a snapshot, so that its queries see the
+    same state, unless already in a snapshot or in a batch. The read is
+    retried if a page file is missing, as removed by another process after
+    the pages were selected."""
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if self._snapshot or self._batch:
+            return method(self,*args,**kwargs)
+        for attempt in range(self.retries):
+            try:
+                with self.snapshot():
+                    return method(self,*args,**kwargs)
+            except (IOError,OSError) as e:
+                if getattr(e,'errno',None)!=errno.ENOENT or \
+                   attempt+1==self.retries:
+                    raise
+    return wrapper
+
+
 def merge(idx0,rec0,idx1,rec1):
-    sel={};val=[rec0,rec1]
-    for ii,iv in enumerate(idx0):
-        sel[iv]=(0,ii)
-    for ii,iv in enumerate(idx1):
-        sel[iv]=(1,ii)
-    idx=[];rec=[]
-    for sv,(ir,ii) in sorted(sel.items()):
-        idx.append(sv)
-        rec.append(val[ir][ii])
+    """Merge idx1,rec1 into idx0,rec0 sorted by index, the last record
+    winning for repeated indices"""
+    idx=np.concatenate([idx0,idx1])
+    order=np.argsort(idx,kind='mergesort')
+    idx=idx[order]
+    last=np.r_[idx[1:]!=idx[:-1],True]
+    idx=idx[last];order=order[last]
+    try:
+      rec=np.concatenate([np.asarray(rec0),np.asarray(rec1)])
+      if rec.dtype==object:
+        raise ValueError
+      rec=rec[order]
+    except ValueError:
+      # variable length records
+      rec=list(rec0)+list(rec1)
+      rec=[rec[ii] for ii in order]
     return idx,rec
 
+def cut(idx,rec,idxa,idxb):
+    """Return the records of idx,rec between idxa and idxb"""
+    a=idx.searchsorted(idxa,side='left') if idxa is not None else 0
+    b=idx.searchsorted(idxb,side='right') if idxb is not None else len(idx)
+    return idx[a:b],rec[a:b]
+
+operators={'>':operator.gt,'>=':operator.ge,'<':operator.lt,
+           '<=':operator.le,'==':operator.eq,'!=':operator.ne}
+
+def page_match(page,op,value):
+    """Return True if all the records of page satisfy op value according
+    to the page summary, False if none does, None if unknown"""
+    if op not in operators:
+      raise ValueError("Unknown operator %r"%op)
+    if page.nancount!=0 or page.vmin is None:
+      return None
+    vmin,vmax=page.vmin,page.vmax
+    if op=='>':
+      return True if vmin>value else False if vmax<=value else None
+    elif op=='>=':
+      return True if vmin>=value else False if vmax<value else None
+    elif op=='<':
+      return True if vmax<value else False if vmin>=value else None
+    elif op=='<=':
+      return True if vmax<=value else False if vmin>value else None
+    inside=vmin<=value<=vmax
+    same=vmin==vmax==value
+    if op=='==':
+      return True if same else None if inside else False
+    return False if same else None if inside else True
+
+def match_records(rec,predicate):
+    """Return the boolean mask of the records satisfying predicate"""
+    if callable(predicate):
+      return np.asarray(predicate(rec),dtype=bool)
+    op,value=predicate
+    cmp=operators[op]
+    if isinstance(rec,list):
+      return np.array([np.any(cmp(np.asarray(rr),value)) for rr in rec],
+                      dtype=bool)
+    mask=cmp(np.asarray(rec),value)
+    if mask.ndim>1:
+      mask=mask.reshape(len(rec),-1).any(axis=1)
+    return mask
+
+def align(master,idx,rec,how='previous'):
+    """Return the records rec at idx aligned to the timestamps master as
+    floats, NaN where not defined. how is 'previous' for the last record at
+    or before each timestamp, 'nearest' for the closest one or 'interp' for
+    a linear interpolation."""
+    try:
+      rec=np.asarray(rec,dtype=float)
+    except ValueError:
+      raise ValueError("Only numbers and vectors of numbers can be aligned")
+    out=np.full((len(master),)+rec.shape[1:],np.nan)
+    if len(idx)==0:
+      return out
+    if how=='interp':
+      flat=rec.reshape(len(idx),-1)
+      out=out.reshape(len(master),-1)
+      for col in range(flat.shape[1]):
+        out[:,col]=np.interp(master,idx,flat[:,col],left=np.nan,right=np.nan)
+      return out.reshape((len(master),)+rec.shape[1:])
+    pos=idx.searchsorted(master,side='right')-1
+    if how=='nearest':
+      before=np.maximum(pos,0)
+      after=np.minimum(pos+1,len(idx)-1)
+      closer=np.abs(idx[after]-master)<np.abs(master-idx[before])
+      pos=np.where((pos<0)|closer,after,before)
+    elif how!='previous':
+      raise ValueError("Unknown alignment %r"%how)
+    valid=pos>=0
+    out[valid]=rec[pos[valid]]
+    return out
+
+def rechunk(blocks,chunk_records):
+    """Regroup the variable,idx,rec blocks of each variable in blocks of
+    chunk_records records"""
+    buf=[];count=0;current=None
+    for variable,idx,rec in blocks:
+      if variable!=current and buf:
+        yield (current,)+join_blocks(buf)
+        buf=[];count=0
+      current=variable
+      while len(idx)>0:
+        take=chunk_records-count
+        buf.append((idx[:take],rec[:take]))
+        count+=len(buf[-1][0])
+        idx=idx[take:];rec=rec[take:]
+        if count==chunk_records:
+          yield (current,)+join_blocks(buf)
+          buf=[];count=0
+    if buf:
+      yield (current,)+join_blocks(buf)
+
+def copy_records(idx,rec):
+    """Return writable copies of idx,rec, the arrays kept in the page cache
+    being read-only"""
+    if isinstance(rec,list):
+      rec=[rrr.copy() if hasattr(rrr,'copy') else rrr for rrr in rec]
+    else:
+      rec=rec.copy()
+    return idx.copy(),rec
+
+def join_blocks(blocks):
+    if len(blocks)==1:
+      return blocks[0]
+    idx,rec=zip(*blocks)
+    return concatenate(idx),concatenate(rec)
+
 def concatenate(val):
     try:
       return np.concatenate(val)
@@ -39,6 +197,29 @@ def concatenate(val):
 
 _suffixes = ['bytes', 'KiB', 'MiB', 'GiB', 'TiB', 'EiB', 'ZiB']
 
+# columns of pages needed to build a Page, in the order of Page.__init__
+page_columns="""pageid,idxtype,count,idxa,idxb,rectype,reclen,recsize,comp,
+                checksum,encoding,disksize,segment,segoffset,idxbytes,
+                lenbytes,vmin,vmax,vsum,vm2,nancount"""
+
+schema_version=1
+
+# columns added to the tables of schema version 1, created when missing
+added_columns=[('variables',[('comp','STRING'),
+                             ('encoding','STRING'),
+                             ('parent','INTEGER')]),
+               ('pages',[('encoding','STRING'),
+                         ('disksize','INTEGER'),
+                         ('segment','INTEGER'),
+                         ('segoffset','INTEGER'),
+                         ('idxbytes','INTEGER'),
+                         ('lenbytes','INTEGER'),
+                         ('vmin','NUMERIC'),
+                         ('vmax','NUMERIC'),
+                         ('vsum','NUMERIC'),
+                         ('vm2','NUMERIC'),
+                         ('nancount','INTEGER')])]
+
 def human_readable(size,suffixes=' kMGTEZ'):
     order = int(np.log10(size)/3) if size else 0
     return ('%.4g%s'%(size/(10.**(order*3)),suffixes[order])).rstrip()
@@ -52,35 +233,136 @@ class PageStore(object):
     def __init__(self,dbname,pagedir,maxpagesize=None,
                       checksum=False,
                       keep_deleted_pages=False,
-                      readonly=False):
+                      readonly=False,
+                      cachesize=2**27,
+                      comp=None,
+                      encoding=None,
+                      segmentsize=None,
+                      rollups=None,
+                      timeout=30.,
+                      retries=5,
+                      wal=True):
+        """Open or create the store. With wal (default) the database uses
+        write-ahead logging, so that readers in other processes are not
+        blocked by a writer. Writers wait up to timeout seconds for the
+        lock of another writer, retries times with increasing delays.
+
+        With readonly the database is opened in place without writing to
+        it. A database with an older schema is copied to a temporary file
+        and migrated there."""
+        self.dbname=dbname
+        self.timeout=timeout
+        self.retries=retries
+        self.readonly=readonly
+        self._tmpcopy=None
+        self._batch=0
+        self._snapshot=0
         try:
-            if dbname.startswith('file:'):
+            if readonly or dbname.startswith('file:'):
+               uri=dbname
+               if not uri.startswith('file:'):
+                  uri='file:'+pathname2url(os.path.abspath(dbname))
                if readonly:
-                  dbname+='?mode=ro'
-               self.db=sqlite3.connect(dbname,
+                  uri+=('&' if '?' in uri else '?')+'mode=ro'
+               self.db=sqlite3.connect(uri,timeout=timeout,
                        isolation_level="IMMEDIATE",uri=True)
             else:
-               if readonly:
-                 tmp=tempfile.mktemp()
-                 shutil.copy2(dbname,tmp)
-                 dbname=tmp
-               self.db=sqlite3.connect(dbname,
+               self.db=sqlite3.connect(dbname,timeout=timeout,
                        isolation_level="IMMEDIATE")
+            if readonly and self.schema_outdated():
+               self._open_copy(dbname)
+            elif wal and not readonly:
+               self._retry(self.db.execute,"PRAGMA journal_mode=WAL")
+               self.db.execute("PRAGMA synchronous=NORMAL")
         except sqlite3.Error as e:
-          print(e.msg)
+          print(e)
           print('Error creating database %s'%dbname)
           sys.exit(1)
-        self.dbname=dbname
-        self.create_db()
+        if not readonly:
+          self._retry(self.create_db)
         self.set_pagedir(pagedir)
         self.set_var('maxpagesize',maxpagesize,2**24)
+        self.set_var('comp',comp)
+        self.set_var('encoding',encoding)
+        self.set_var('segmentsize',segmentsize,0)
+        self.set_var('rollups',rollups,())
+        if isstr(self.rollups):
+          self.rollups=self.rollups.split(',')
+        self.rollups=sorted(float(width) for width in self.rollups)
         self.checksum=checksum
         self.keep_deleted_pages=keep_deleted_pages
+        self._nextpageid=None
+        self._varids={}
+        self._newpages=[]
+        self._trash=[]
+        self._appended=[]
+        self._segment=None
+        self.cachesize=cachesize
+        self._cache=OrderedDict()
+        self._cachebytes=0
+        self.cache_hits=0
+        self.cache_misses=0
+        self.cache_evictions=0
+        self._dataversion=None
+    def _retry(self,func,*args):
+        """Call func(*args), retrying with exponential backoff while the
+        database is locked by another connection"""
+        delay=0.05
+        for attempt in range(self.retries):
+          try:
+            return func(*args)
+          except sqlite3.OperationalError as e:
+            if not is_locked(e) or attempt+1==self.retries:
+              raise
+            time.sleep(delay*(1+random.random()))
+            delay*=2
+    def _open_copy(self,dbname):
+        """Replace the read-only connection by one to a migrated copy"""
+        warnings.warn("%s has an older schema, reading a migrated "
+                      "temporary copy"%dbname)
+        fd,tmp=tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        copy=sqlite3.connect(tmp)
+        # the backup includes the commits in the write-ahead log
+        self.db.backup(copy)
+        copy.close()
+        self.db.close()
+        self._tmpcopy=tmp
+        self.db=sqlite3.connect(tmp,timeout=self.timeout,
+                                isolation_level="IMMEDIATE")
+        self.create_db()
     def create_db(self):
+        """Create or upgrade the schema in one transaction, setting the
+        schema version last. The write lock is not taken if the schema is
+        up to date."""
+        version=self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version>=schema_version:
+          return self
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+          # read under the write lock, so that only one process migrates
+          version=self.db.execute("PRAGMA user_version").fetchone()[0]
+          if version<schema_version and self._has_table('pages'):
+            self.migrate_db(version)
+          else:
+            self._create_tables()
+          self.db.execute("PRAGMA user_version=%d"%schema_version)
+        except:
+          self.db.rollback()
+          raise
+        self.db.commit()
+        return self
+    def _create_tables(self):
         sql="""
+        CREATE TABLE IF NOT EXISTS variables(
+              varid  INTEGER PRIMARY KEY,
+              name   STRING UNIQUE,
+              comp   STRING,
+              encoding STRING,
+              parent INTEGER);
         CREATE TABLE IF NOT EXISTS pages(
-              name   STRING,
-              pageid INTEGER,
+              pageid INTEGER PRIMARY KEY,
+              varid  INTEGER,
               idxtype STRING,
               count   INTEGER,
               idxa    NUMERIC,
@@ -91,15 +373,77 @@ class PageStore(object):
               comp    STRING,
               created NUMERIC,
               checksum STRING,
-              deleted NUMERIC);
-        CREATE INDEX IF NOT EXISTS page_index ON pages(pageid);
+              deleted NUMERIC,
+              encoding STRING,
+              disksize INTEGER,
+              segment INTEGER,
+              segoffset INTEGER,
+              idxbytes INTEGER,
+              lenbytes INTEGER,
+              vmin    NUMERIC,
+              vmax    NUMERIC,
+              vsum    NUMERIC,
+              vm2     NUMERIC,
+              nancount INTEGER);
+        CREATE INDEX IF NOT EXISTS pages_idxa ON pages(varid,idxa,idxb);
+        CREATE INDEX IF NOT EXISTS pages_idxb ON pages(varid,idxb);
         CREATE TABLE IF NOT EXISTS conf(
               variable STRING,
               value   STRING,
-              timestamp STRING);"""
-        self.db.executescript(sql)
-        self.db.commit()
-        return self
+              timestamp STRING)"""
+        for statement in sql.split(';'):
+          self.db.execute(statement)
+        for table,columns in added_columns:
+          self._add_columns(table,columns)
+        sql="CREATE INDEX IF NOT EXISTS variables_parent ON variables(parent)"
+        self.db.execute(sql)
+    def schema_outdated(self):
+        """True if create_db needs to create or upgrade the schema"""
+        version=self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version<schema_version or not self._has_table('conf'):
+          return True
+        for table,columns in added_columns:
+          if self._missing_columns(table,columns):
+            return True
+        return False
+    def _missing_columns(self,table,columns):
+        cur=self.db.execute("PRAGMA table_info(%s)"%table)
+        existing=set(row[1] for row in cur)
+        return [(name,coltype) for name,coltype in columns
+                if name not in existing]
+    def _add_columns(self,table,columns):
+        """Add the columns missing in a table created by an older version"""
+        for name,coltype in self._missing_columns(table,columns):
+          sql="ALTER TABLE %s ADD COLUMN %s %s"%(table,name,coltype)
+          self.db.execute(sql)
+    def _has_table(self,table):
+        sql="SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+        return self.db.execute(sql,[table]).fetchone() is not None
+    def migrate_db(self,version):
+        """Upgrade the schema of a database created by an older version,
+        inside the transaction of create_db"""
+        if version==0:
+          print("Migrating %s to schema version 1"%self.dbname)
+          self.db.execute("DROP INDEX IF EXISTS page_index")
+          self.db.execute("ALTER TABLE pages RENAME TO pages_v0")
+          self._create_tables()
+          sql="INSERT INTO variables(name) SELECT DISTINCT name FROM pages_v0"
+          self.db.execute(sql)
+          cols="""pageid,varid,idxtype,count,idxa,idxb,
+                  rectype,reclen,recsize,comp,created,checksum,deleted"""
+          sql="""INSERT INTO pages(%s) SELECT %s
+                   FROM pages_v0 JOIN variables USING(name)"""%(
+                   cols,cols.replace('comp','pages_v0.comp'))
+          self.db.execute(sql)
+          # numpy scalars used to be stored as raw bytes
+          sql="""SELECT pageid,idxtype,idxa,idxb FROM pages
+                   WHERE typeof(idxa)=='blob' OR typeof(idxb)=='blob'"""
+          for pageid,idxtype,idxa,idxb in self.db.execute(sql).fetchall():
+            idxa,idxb=[np.frombuffer(v,dtype=idxtype)[0].item()
+                       if isinstance(v,bytes) else v for v in (idxa,idxb)]
+            sql="UPDATE pages SET idxa=?,idxb=? WHERE pageid=?"
+            self.db.execute(sql,[idxa,idxb,pageid])
+          self.db.execute("DROP TABLE pages_v0")
     def set_var(self,name,value,default=None):
         if value is None:
             value=self.get_var(name)
@@ -108,14 +452,13 @@ class PageStore(object):
         setattr(self,name,value)
         return value
     def store_var(self,name,value):
-        cur=self.db.cursor()
-        sql="INSERT INTO conf VALUES (?,?,datetime('now'))"
-        cur.execute(sql,(name,value))
-        self.db.commit()
+        with self.batch():
+          sql="INSERT INTO conf VALUES (?,?,datetime('now'))"
+          self.db.execute(sql,(name,value))
     def set_pagedir(self,dirpath):
         if dirpath is None:
             dirpath=self.get_var('pagedir','data')
-        if not os.path.isdir(dirpath):
+        if not os.path.isdir(dirpath) and not self.readonly:
             os.mkdir(dirpath)
         dirpath=os.path.abspath(dirpath)
         self.set_var('pagedir',dirpath)
@@ -140,29 +483,220 @@ class PageStore(object):
         if lastid is None:
             return 0
         return lastid
+    def new_pageid(self):
+        if self._batch:
+          pageid=self._nextpageid
+          self._nextpageid+=1
+          return pageid
+        return self.get_last_pageid()+1
+    @contextmanager
+    def batch(self):
+        """Group all writes in one transaction, committed at the end:
+
+        with db.batch():
+            db.store_variable(name1,idx1,rec1)
+            db.store_variable(name2,idx2,rec2)
+
+        The write lock of the database is taken at the start, so that
+        other processes wait for the end of the batch. Page files of deleted
+        pages are removed after the commit. If the block raises, new page
+        files are removed and pages appended in place and segment files are
+        truncated to their previous size."""
+        if self._batch==0:
+          if self.readonly:
+            raise ValueError("%s is opened read-only"%self.dbname)
+          if self._snapshot:
+            raise ValueError("Cannot write inside a snapshot")
+          if not getattr(self.db,'in_transaction',False):
+            self._retry(self.db.execute,"BEGIN IMMEDIATE")
+          # other processes may have added pages and segments
+          self._nextpageid=self.get_last_pageid()+1
+          self._segment=None
+        self._batch+=1
+        try:
+          yield self
+        except:
+          if self._batch==1:
+            self.db.rollback()
+            self._varids={}
+            for page in self._newpages:
+              self._cache_drop(page.pageid)
+              page.delete()
+            for fname,size in reversed(self._appended):
+              with open(fname,'r+b') as fh:
+                fh.truncate(size)
+            if self._appended:
+              # pages read in the batch may be cached with the new records
+              self._cache.clear()
+              self._cachebytes=0
+            self._newpages=[];self._trash=[];self._appended=[]
+          raise
+        finally:
+          self._batch-=1
+        if self._batch==0:
+          self.db.commit()
+          for page in self._trash:
+            page.delete()
+          self._newpages=[];self._trash=[];self._appended=[]
+    @contextmanager
+    def snapshot(self):
+        """Read a consistent state of the database:
+
+        with db.snapshot():
+            data=db.get(['var1','var2'],t1,t2)
+
+        The commits of other processes during the block are not seen.
+        Their deleted page files are still removed, unless writers keep
+        deleted pages and prune them later, see prune_delete_pages."""
+        if self._batch:
+          raise ValueError("Cannot take a snapshot inside a batch")
+        if self._snapshot==0:
+          self._retry(self.db.execute,"BEGIN")
+          # the read transaction starts with the first read
+          self.db.execute("SELECT COUNT(*) FROM variables").fetchone()
+        self._snapshot+=1
+        try:
+          yield self
+        finally:
+          self._snapshot-=1
+          if self._snapshot==0:
+            self.db.rollback()
+    def get_varid(self,variable,create=False):
+        varid=self._varids.get(variable)
+        if varid is None:
+          sql="SELECT varid FROM variables WHERE name=?"
+          res=self.db.execute(sql,[variable]).fetchone()
+          if res is not None:
+            varid=res[0]
+          elif create:
+            sql="INSERT INTO variables(name) VALUES (?)"
+            varid=self.db.execute(sql,[variable]).lastrowid
+          else:
+            return None
+          self._varids[variable]=varid
+        return varid
+    def close(self):
+        """Close the database, removing the temporary copy of a read-only
+        store with an older schema"""
+        self.db.close()
+        if self._tmpcopy is not None:
+          os.unlink(self._tmpcopy)
+          self._tmpcopy=None
     def delete(self):
+        if self.readonly:
+          raise ValueError("%s is opened read-only"%self.dbname)
+        self.db.close()
         if os.path.exists(self.pagedir):
           shutil.rmtree(self.pagedir)
         os.unlink(self.dbname)
-    def store_page(self,variable,idx,rec,commit=True):
+        for fname in (self.dbname+'-wal',self.dbname+'-shm'):
+          if os.path.exists(fname):
+            os.unlink(fname)
+    def _set_varconf(self,variable,column,value):
+        with self.batch():
+          varid=self.get_varid(variable,create=True)
+          sql="UPDATE variables SET %s=? WHERE varid=?"%column
+          self.db.execute(sql,[value,varid])
+    def _get_varconf(self,variable,column):
+        sql="SELECT %s FROM variables WHERE name=?"%column
+        res=self.db.execute(sql,[variable]).fetchone()
+        if res is None or res[0] is None:
+          return getattr(self,column)
+        return res[0]
+    def set_comp(self,variable,comp):
+        """Set the codec of the new pages of variable, None to use the
+        default of the store"""
+        if comp is not None:
+          compression.get_codec(comp)
+        self._set_varconf(variable,'comp',comp)
+    def get_comp(self,variable):
+        return self._get_varconf(variable,'comp')
+    def set_encoding(self,variable,encoding):
+        """Set the encoding of the new pages of variable as 'idx,rec',
+        e.g. 'dod,xor', 'dod,' or None to use the default of the store"""
+        idxenc,recenc=encoders.split_encoding(encoding)
+        if idxenc is not None and idxenc not in encoders.idx_encoders or \
+           recenc is not None and recenc not in encoders.rec_encoders:
+          raise ValueError("Unknown encoding %r"%encoding)
+        self._set_varconf(variable,'encoding',encoding)
+    def get_encoding(self,variable):
+        return self._get_varconf(variable,'encoding')
+    def store_page(self,variable,idx,rec):
         #print("Store page %s"%variable)
-        pageid=self.get_last_pageid()+1
-        page=Page.from_data(idx,rec,self.pagedir,pageid)
-        sql="""INSERT INTO pages VALUES
-             (?,?,?,?,?,?,?,?,?,?,?,?,?)"""
-        self.db.execute(sql,[variable]+page._tolist()+[None])
-        if commit:
-          self.db.commit()
+        with self.batch():
+          pageid=self.new_pageid()
+          append_segment=None
+          if int(self.segmentsize)>0:
+            append_segment=self._append_segment
+          page=Page.from_data(idx,rec,self.pagedir,pageid,
+                              comp=self.get_comp(variable),
+                              encoding=self.get_encoding(variable),
+                              append_segment=append_segment)
+          self._newpages.append(page)
+          varid=self.get_varid(variable,create=True)
+          sql="""INSERT INTO pages(pageid,idxtype,count,idxa,idxb,rectype,
+                    reclen,recsize,comp,created,checksum,encoding,disksize,
+                    segment,segoffset,idxbytes,lenbytes,
+                    vmin,vmax,vsum,vm2,nancount,varid)
+               VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+          self.db.execute(sql,page._tolist()+[varid])
+    def _append_segment(self,data):
+        """Append data at the end of the current segment file, starting a
+        new one after segmentsize bytes. Return segment,segoffset"""
+        if self._segment is None:
+          self._segment=max([0]+list(self._segment_files()))
+        fname=segment_path(self.pagedir,self._segment)
+        size=os.path.getsize(fname) if os.path.exists(fname) else 0
+        if size>0 and size+len(data)>int(self.segmentsize):
+          self._segment+=1
+          fname=segment_path(self.pagedir,self._segment)
+          size=os.path.getsize(fname) if os.path.exists(fname) else 0
+        if size==0 and not os.path.isdir(os.path.dirname(fname)):
+          os.makedirs(os.path.dirname(fname))
+        with open(fname,'ab') as fh:
+          fh.write(data)
+        if self._batch:
+          self._appended.append((fname,size))
+        return self._segment,size
+    def _segment_files(self):
+        """Return {segment: path} of the segment files"""
+        segdir=os.path.dirname(segment_path(self.pagedir,0))
+        out={}
+        if os.path.isdir(segdir):
+          for fname in os.listdir(segdir):
+            name,ext=os.path.splitext(fname)
+            if ext=='.seg' and name.isdigit():
+              out[int(name)]=os.path.join(segdir,fname)
+        return out
+    def _sync_cache(self):
+        """Empty the page cache if another connection committed since the
+        last check, as pages can be appended in place and page ids reused"""
+        version=self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version!=self._dataversion:
+          self._dataversion=version
+          self._cache.clear()
+          self._cachebytes=0
     def get_pages(self,variable,idxa=None,idxb=None):
+        self._sync_cache()
         cur=self.db.cursor()
+        varid=self.get_varid(variable)
         idxa,idxb=self.get_lim(variable,idxa,idxb)
-        sql="""SELECT pageid,idxtype,count,idxa,idxb,
-                      rectype,reclen,recsize,comp,checksum
-               FROM pages WHERE name==? AND idxb>=? AND idxa<=?
+        if varid is None or idxa is None:
+          return []
+        # pages of a variable do not overlap: the first page ending after
+        # idxa bounds the scan of the (varid,idxa,idxb) index
+        sql="""SELECT idxa FROM pages WHERE varid=? AND idxb>=?
+               AND deleted IS NULL ORDER BY idxb LIMIT 1"""
+        first=cur.execute(sql,[varid,idxa]).fetchone()
+        if first is None:
+          return []
+        sql="""SELECT %s FROM pages
+               WHERE varid=? AND idxa>=? AND idxa<=? AND idxb>=?
                AND deleted IS NULL
-               ORDER BY idxa"""
-        pages=list(cur.execute(sql,[variable,idxa,idxb]))
+               ORDER BY idxa"""%page_columns
+        pages=list(cur.execute(sql,[varid,first[0],idxb,idxa]))
         return pages
+    @read_transaction
     def get(self,variables,idxa=None,idxb=None):
         data={}
         if isstr(variables):
@@ -172,24 +706,324 @@ class PageStore(object):
         for variable in varlist:
             data[variable]=self.get_variable(variable,idxa=idxa,idxb=idxb)
         return data
-    def get_variable(self,variable,idxa=None,idxb=None):
+    @read_transaction
+    def get_variable(self,variable,idxa=None,idxb=None,
+                     resolution=None,maxpoints=None):
+        """Return idx,rec of variable between idxa and idxb.
+
+        With resolution or maxpoints, return the records [min,max,mean,count]
+        of the coarsest rollup with buckets not larger than resolution, or
+        of the finest one with at most maxpoints buckets, unless the raw
+        data fits in maxpoints."""
+        if resolution is not None or maxpoints is not None:
+          width,name=self.select_rollup(variable,idxa,idxb,
+                                        resolution,maxpoints)
+          if width>0:
+            if idxa is not None:
+              idxa=idxa//width*width
+            return self.get_variable(name,idxa,idxb)
         idxa,idxb=self.get_lim(variable,idxa,idxb)
         pages=self.get_pages(variable,idxa,idxb)
         if len(pages)>0:
-          page=Page(self.pagedir,*pages[0],check=True)
-          out=[page.get(idxa,idxb)]
-          for res in pages[1:-1]:
-            page=Page(self.pagedir,*res,check=True)
-            out.append(page.get_all())
-          if len(pages)>1:
-            page=Page(self.pagedir,*pages[-1],check=True)
-            out.append(page.get(idxa,idxb))
+          out=[self.read_page(Page(self.pagedir,*res),idxa,idxb)
+               for res in pages]
           idx,rec=zip(*out)
           idx=concatenate(idx)
           rec=concatenate(rec)
         else:
           idx=np.array([]);rec=np.array([])
         return idx,rec
+    def iter_variable(self,variable,idxa=None,idxb=None,
+                      chunk_records=None,readahead=True):
+        """Yield idx,rec of variable between idxa and idxb page by page, or
+        in blocks of chunk_records records, keeping only a few pages in
+        memory. See iter_many."""
+        for _,idx,rec in self.iter_many([variable],idxa,idxb,
+                                        chunk_records,readahead):
+          yield idx,rec
+    def iter_many(self,variables,idxa=None,idxb=None,
+                  chunk_records=None,readahead=True):
+        """Yield variable,idx,rec of the variables between idxa and idxb,
+        one variable after the other, page by page or in blocks of
+        chunk_records records.
+
+        With readahead the next page is read in a background thread while
+        the current block is processed. Pages found in the cache are used,
+        pages read are not added to it.
+
+        The iteration does not hold a snapshot. If a page file is removed
+        by another process, the pages of its variable are selected again
+        and the iteration continues after the last record yielded."""
+        if isstr(variables):
+          variables=self.search(variables)
+        tasks=self._page_tasks(variables,idxa,idxb)
+        blocks=self._iter_pages(tasks,readahead)
+        if chunk_records is not None:
+          blocks=rechunk(blocks,chunk_records)
+        for block in blocks:
+          yield block
+    @read_transaction
+    def _page_tasks(self,variables,idxa,idxb):
+        """Return the (variable,page,idxa,idxb) to read for variables"""
+        tasks=[]
+        for variable in variables:
+          va,vb=self.get_lim(variable,idxa,idxb)
+          for res in self.get_pages(variable,va,vb):
+            tasks.append((variable,Page(self.pagedir,*res),va,vb))
+        return tasks
+    def _retry_tasks(self,tasks,last):
+        """Select again the pages of the variable of tasks[0] after the
+        last (variable,idx) yielded, followed by the other tasks"""
+        variable,page,idxa,idxb=tasks[0]
+        if last is not None and last[0]==variable:
+          idxa=last[1]
+        nvar=1
+        while nvar<len(tasks) and tasks[nvar][0]==variable:
+          nvar+=1
+        return self._page_tasks([variable],idxa,idxb)+tasks[nvar:]
+    def _iter_pages(self,tasks,readahead):
+        pool=None
+        if readahead and len(tasks)>1:
+          pool=ThreadPool(1)
+        def load(task):
+          # the cache and sqlite are used only from this thread
+          variable,page,idxa,idxb=task
+          data=self._cache_get(page.pageid,idxa,idxb)
+          if data is not None:
+            return data
+          if pool is None:
+            return self._read_page_uncached(page,idxa,idxb)
+          return pool.apply_async(self._read_page_uncached,(page,idxa,idxb))
+        try:
+          data=None;last=None;attempt=0;ii=0
+          while ii<len(tasks):
+            task=tasks[ii]
+            try:
+              if data is None:
+                data=load(task)
+              if not isinstance(data,tuple):
+                data=data.get()
+            except (IOError,OSError) as e:
+              # page removed by another process after it was selected
+              attempt+=1
+              if getattr(e,'errno',None)!=errno.ENOENT or \
+                 self._snapshot or self._batch or attempt==self.retries:
+                raise
+              tasks=tasks[:ii]+self._retry_tasks(tasks[ii:],last)
+              data=None
+              continue
+            idx,rec=data
+            data=None;attempt=0;ii+=1
+            if pool is not None and ii<len(tasks):
+              data=load(tasks[ii])
+            if last is not None and last[0]==task[0]:
+              # records already yielded before the pages were selected again
+              start=int(np.searchsorted(idx,last[1],side='right'))
+              idx,rec=idx[start:],rec[start:]
+            if len(idx)>0:
+              last=(task[0],idx[-1])
+              yield task[0],idx,rec
+        finally:
+          if pool is not None:
+            pool.close()
+            pool.join()
+    @read_transaction
+    def get_aligned(self,variables,master=None,idxa=None,idxb=None,
+                    how='previous',out='dict',nthreads=4):
+        """Return the variables between idxa and idxb aligned to the
+        timestamps of master (by default the first variable), see align.
+
+        With out='dict' return {'timestamps':idx,variable:values,...} as
+        LoggingDB.getAligned, with out='array' return idx and a 2-D float
+        array with one column per variable. Pages are read in nthreads
+        threads."""
+        if isstr(variables):
+          variables=self.search(variables)
+        variables=list(variables)
+        if master is None:
+          master=variables[0]
+        idxa,idxb=self.get_lim(master,idxa,idxb)
+        if idxa is None:
+          return {} if out=='dict' else (np.array([]),np.zeros((0,0)))
+        names=[master]+[vv for vv in variables if vv!=master]
+        tasks=[];owners=[]
+        for ii,variable in enumerate(names):
+          pages=[Page(self.pagedir,*res)
+                 for res in self.get_pages(variable,idxa,idxb)]
+          if ii==0:
+            vartasks=[(page,idxa,idxb) for page in pages]
+          else:
+            # whole pages, with the records just before and after the range
+            # to align the first and last timestamps
+            vartasks=[(page,page.idxa,page.idxb) for page in pages]
+            before,after=self.get_neighbours(variable,idxa,idxb)
+            if before and (not pages or pages[0].idxa>idxa):
+              page=Page(self.pagedir,*before[0])
+              vartasks.insert(0,(page,page.idxb,page.idxb))
+            if after and (not pages or pages[-1].idxb<idxb):
+              page=Page(self.pagedir,*after[0])
+              vartasks.append((page,page.idxa,page.idxa))
+          tasks.extend(vartasks)
+          owners.extend([ii]*len(vartasks))
+        data=self._read_pages(tasks,nthreads)
+        blocks=[[] for name in names]
+        for ii,block in zip(owners,data):
+          blocks[ii].append(block)
+        result={}
+        for ii,name in enumerate(names):
+          if blocks[ii]:
+            result[name]=join_blocks(blocks[ii])
+          else:
+            result[name]=np.array([]),np.array([])
+        timestamps,values=result[master]
+        aligned={'timestamps':timestamps}
+        for name in names:
+          if name==master:
+            aligned[name]=np.asarray(values)
+          else:
+            aligned[name]=align(timestamps,*result[name],how=how)
+        if out=='dict':
+          return aligned
+        data=np.empty((len(timestamps),len(variables)))
+        for col,name in enumerate(variables):
+          values=np.asarray(aligned[name],dtype=float)
+          if values.ndim!=1:
+            raise ValueError("%s has not scalar records"%name)
+          data[:,col]=values
+        return timestamps,data
+    def _read_pages(self,tasks,nthreads=4):
+        """Return idx,rec of each page,idxa,idxb in tasks, reading the pages
+        not in the cache in nthreads threads. The whole pages read are
+        added to the cache."""
+        out=[None]*len(tasks)
+        todo=[]
+        for ii,(page,idxa,idxb) in enumerate(tasks):
+          data=self._cache_get(page.pageid,idxa,idxb)
+          if data is not None:
+            out[ii]=data
+          else:
+            self.cache_misses+=1
+            todo.append(ii)
+        read=lambda ii: self._read_page_uncached(*tasks[ii])
+        if len(todo)>1 and nthreads>1:
+          pool=ThreadPool(min(nthreads,len(todo)))
+          try:
+            res=pool.map(read,todo)
+          finally:
+            pool.close()
+            pool.join()
+        else:
+          res=[read(ii) for ii in todo]
+        for ii,(idx,rec) in zip(todo,res):
+          page,idxa,idxb=tasks[ii]
+          if idxa<=page.idxa and idxb>=page.idxb:
+            self._cache_add(page,idx,rec)
+          out[ii]=idx,rec
+        return out
+    def _read_page_uncached(self,page,idxa,idxb):
+        if self.checksum and page.checksum is not None:
+          assert page.check()
+        if idxa<=page.idxa and idxb>=page.idxb:
+          return page.get_all()
+        return page.get(idxa,idxb)
+    @read_transaction
+    def stats(self,variable,idxa=None,idxb=None):
+        """Return the Stat of variable between idxa and idxb, as
+        LoggingDB.getStats, merging the statistics of each page. Pages
+        inside the range are summarized from the page table, only the
+        boundary pages and pages without summary are read."""
+        idxa,idxb=self.get_lim(variable,idxa,idxb)
+        acc=StatAccumulator()
+        for res in self.get_pages(variable,idxa,idxb):
+          page=Page(self.pagedir,*res)
+          summary=None
+          if idxa<=page.idxa and page.idxb<=idxb:
+            summary=page.get_summary()
+          if summary is None:
+            acc.add(*self.read_page(page,idxa,idxb))
+          else:
+            acc.merge(summary)
+        return acc.stat()
+    @read_transaction
+    def find(self,variable,predicate,idxa=None,idxb=None,limit=None):
+        """Return the index of the records of variable between idxa and
+        idxb satisfying predicate, at most limit.
+
+        predicate is (op,value) with op one of > >= < <= == !=, true for
+        vectors if true for any element, or a function of the records
+        returning a boolean array. With (op,value), pages whose summary
+        excludes or includes all records are not read or only their index
+        is read."""
+        idxa,idxb=self.get_lim(variable,idxa,idxb)
+        out=[];found=0
+        for res in self.get_pages(variable,idxa,idxb):
+          page=Page(self.pagedir,*res)
+          match=None
+          if not callable(predicate):
+            match=page_match(page,*predicate)
+          if match is False:
+            continue
+          if match is True:
+            idx=page.get_idx(idxa,idxb)
+          else:
+            idx,rec=self.read_page(page,idxa,idxb)
+            idx=idx[match_records(rec,predicate)]
+          out.append(idx)
+          found+=len(idx)
+          if limit is not None and found>=limit:
+            break
+        if len(out)==0:
+          return np.array([])
+        return np.concatenate(out)[:limit]
+    def read_page(self,page,idxa=None,idxb=None):
+        """Return idx,rec of page between idxa and idxb.
+
+        Decoded pages are kept in a LRU cache of cachesize bytes. Pages cut
+        by the limits are read partially when not in the cache, unless the
+        checksum needs to be verified."""
+        whole=((idxa is None or idxa<=page.idxa) and
+               (idxb is None or idxb>=page.idxb))
+        data=self._cache_get(page.pageid,idxa,idxb)
+        if data is not None:
+          return data
+        self.cache_misses+=1
+        if not whole and not self.checksum:
+          return page.get(idxa,idxb)
+        if self.checksum and page.checksum is not None:
+          assert page.check()
+        idx,rec=page.get_all()
+        self._cache_add(page,idx,rec)
+        if whole:
+          return idx,rec
+        return cut(idx,rec,idxa,idxb)
+    def _cache_get(self,pageid,idxa=None,idxb=None):
+        """Return copies of the records of a cached page between idxa and
+        idxb, None if the page is not in the cache"""
+        data=self._cache.pop(pageid,None)
+        if data is None:
+          return None
+        self._cache[pageid]=data
+        self.cache_hits+=1
+        return copy_records(*cut(data[0],data[1],idxa,idxb))
+    def _cache_add(self,page,idx,rec):
+        """Keep read-only copies of idx,rec of page"""
+        size=idx.nbytes+page.recsize
+        if size>self.cachesize:
+          return
+        idx,rec=copy_records(idx,rec)
+        for arr in (idx,rec):
+          if hasattr(arr,'flags'):
+            arr.flags.writeable=False
+        while self._cachebytes+size>self.cachesize:
+          pageid,(_,_,oldsize)=self._cache.popitem(last=False)
+          self._cachebytes-=oldsize
+          self.cache_evictions+=1
+        self._cache[page.pageid]=(idx,rec,size)
+        self._cachebytes+=size
+    def _cache_drop(self,pageid):
+        data=self._cache.pop(pageid,None)
+        if data is not None:
+          self._cachebytes-=data[2]
     def get_idx(self,variable,idxa=None,idxb=None):
         idxa,idxb=self.get_lim(variable,idxa,idxb)
         pages=self.get_pages(variable,idxa,idxb)
@@ -202,6 +1036,7 @@ class PageStore(object):
           page=Page(self.pagedir,*pages[-1])
           out.append(page.get_idx(idxa,idxb))
         return concatenate(out)
+    @read_transaction
     def count(self,variable,idxa=None,idxb=None):
         idxa,idxb=self.get_lim(variable,idxa,idxb)
         pages=self.get_pages(variable,idxa,idxb)
@@ -218,116 +1053,379 @@ class PageStore(object):
           return 0
     def get_page(self,pageid):
         cur=self.db.cursor()
-        sql="""SELECT pageid,idxtype,count,idxa,idxb,
-                      rectype,reclen,recsize,comp,checksum
-               FROM pages WHERE pageid=?"""
+        sql="SELECT %s FROM pages WHERE pageid=?"%page_columns
         page=cur.execute(sql,[pageid]).fetchone()
         return Page(self.pagedir,*page)
-    def delete_page(self,page):
-        cur=self.db.cursor()
-        if self.keep_deleted_pages:
-          sql="""UPDATE pages SET deleted=strftime('%s','now')
-                 WHERE pageid==?"""
-        else:
-          sql="""DELETE FROM pages WHERE pageid==?"""
-          #print("Delete page %s"%page.pageid)
-        cur.execute(sql,[page.pageid])
-        self.db.commit()
-        if self.keep_deleted_pages is False:
-           page.delete()
+    def delete_page(self,page,keep=None):
+        """Delete page, or mark it as deleted if keep (by default
+        keep_deleted_pages) and leave its files for the readers of older
+        snapshots"""
+        if keep is None:
+          keep=self.keep_deleted_pages
+        with self.batch():
+          if keep:
+            sql="""UPDATE pages SET deleted=strftime('%s','now')
+                   WHERE pageid==?"""
+          else:
+            sql="""DELETE FROM pages WHERE pageid==?"""
+            #print("Delete page %s"%page.pageid)
+            self._trash.append(page)
+          self.db.execute(sql,[page.pageid])
+          self._cache_drop(page.pageid)
     def delete_variable(self,variable):
-        for  page in self.get_pages(variable):
-          page=Page(self.pagedir,*page)
-          self.delete_page(page)
+        with self.batch():
+          for  page in self.get_pages(variable):
+            page=Page(self.pagedir,*page)
+            self.delete_page(page)
+          for width,name in self.get_rollups(variable):
+            self.delete_variable(name)
     def store(self,data):
-        for variable,(idx,rec) in data.items():
+        with self.batch():
+          for variable,(idx,rec) in data.items():
             self.store_variable(variable,idx,rec)
-    def store_variable(self,variable,idx,rec):
+    def store_variable(self,variable,idx,rec,rollups=True):
         count=len(idx)
         idx=np.array(idx)
         if count>0:
           if  len(rec)!=count:
             msg="idx,rec length mismatch %d!=%d"%(len(idx),len(rec))
             raise ValueError(msg)
-          idxa=idx[0]
-          idxb=idx[-1]
+          with self.batch():
+            self._store_variable(variable,idx,rec,rollups)
+    def _store_variable(self,variable,idx,rec,rollups):
+        idxa=idx[0]
+        idxb=idx[-1]
+        tail=self.get_tail(variable)
+        if tail is None or idxa>tail.idxb:
+          self.append_variable(variable,idx,rec,tail)
+        else:
           pages=self.get_pages(variable,idxa,idxb)
           pages=[Page(self.pagedir,*res) for res in pages]
           for page in pages:
-            if len(idx)>0:
-             # if idx[0]<page.idxa:
-             #   cut=idx.searchsorted(page.idxa)
-#            #    self.merge_page(variable,page,idx[:cut],rec[:cut])
-             #   self.store_page(variable,idx[:cut],rec[:cut])
-             #   idx=idx[cut:];rec=rec[cut:]
-              if idx[0]<=page.idxb:
-                cut=idx.searchsorted(page.idxb,side='right')
-                self.merge_page(variable,page,idx[:cut],rec[:cut])
-                idx=idx[cut:];rec=rec[cut:]
+            if len(idx)>0 and idx[0]<=page.idxb:
+              cut=idx.searchsorted(page.idxb,side='right')
+              self.merge_page(variable,page,idx[:cut],rec[:cut])
+              idx=idx[cut:];rec=rec[cut:]
           if len(idx)>0:
              self.store_page(variable,idx,rec)
-        if self.maxpagesize>0:
-           self.rebalance(variable,self.maxpagesize)
+          if self.maxpagesize>0:
+             self.rebalance_range(variable,idxa,idxb,self.maxpagesize)
+        if rollups:
+          self.update_rollups(variable,idxa,idxb)
+    def get_tail(self,variable):
+        """Return the last page of variable or None"""
+        varid=self.get_varid(variable)
+        sql="""SELECT %s FROM pages WHERE varid=? AND deleted IS NULL
+               ORDER BY idxb DESC LIMIT 1"""%page_columns
+        res=self.db.execute(sql,[varid]).fetchone()
+        if res is not None:
+          return Page(self.pagedir,*res)
+    def append_variable(self,variable,idx,rec,tail=None):
+        """Store records following the last page of variable: fill the
+        tail page in place up to maxpagesize, then start new pages.
+        Compressed, encoded and variable length tail pages cannot grow in
+        place and are merged with the new pages instead."""
+        maxpagesize=int(self.maxpagesize)
+        if maxpagesize<=0:
+          maxpagesize=None
+        with self.batch():
+          grown=False
+          if tail is not None and tail.recsize>0:
+            room=len(idx)
+            if maxpagesize is not None:
+              recbytes=tail.recsize//tail.count
+              room=max(0,(maxpagesize-tail.recsize)//recbytes)
+            if room>0 and self._append_tail(tail,idx[:room],rec[:room]):
+              idx=idx[room:];rec=rec[room:]
+              grown=True
+          step=max(1,len(idx))
+          if maxpagesize is not None and len(idx)>0:
+            recbytes=max(1,np.asarray(rec[0]).nbytes)
+            step=max(1,maxpagesize//recbytes)
+          for i in range(0,len(idx),step):
+            self.store_page(variable,idx[i:i+step],rec[i:i+step])
+          if maxpagesize is None or len(idx)==0:
+            pass
+          elif int(self.segmentsize)>0:
+            self._merge_tail(variable,maxpagesize)
+          elif tail is not None and not grown:
+            self.rebalance_range(variable,idx[0],idx[-1],maxpagesize)
+    def _append_tail(self,tail,idx,rec):
+        """Append idx,rec in place to the tail page, return False if the
+        page cannot be extended"""
+        with self.batch():
+          sizes=[(fname,os.path.getsize(fname)) for fname in tail._files()]
+          if not tail.append(idx,rec,self.checksum):
+            return False
+          self._appended.extend(sizes)
+          sql="""UPDATE pages SET count=?,idxb=?,recsize=?,checksum=?,
+                   disksize=?,vmin=?,vmax=?,vsum=?,vm2=?,nancount=?
+                 WHERE pageid=?"""
+          self.db.execute(sql,[tail.count,tail.idxb,tail.recsize,
+                               tail.checksum,tail.disksize,
+                               tail.vmin,tail.vmax,tail.vsum,tail.vm2,
+                               tail.nancount,tail.pageid])
+          self._cache_drop(tail.pageid)
+        return True
+    def get_rollups(self,variable):
+        """Return the [(width,name)] of the rollups of variable, finest
+        first"""
+        varid=self.get_varid(variable)
+        if varid is None:
+          return []
+        sql="SELECT name FROM variables WHERE parent=?"
+        names=[res[0] for res in self.db.execute(sql,[varid])]
+        return sorted((float(name.rsplit('@',1)[1]),name) for name in names)
+    def update_rollups(self,variable,idxa,idxb):
+        """Recompute the buckets overlapping idxa,idxb of the rollups of
+        variable, the ones in self.rollups and the ones already stored.
+
+        A rollup of width w is stored as variable@w with records
+        [min,max,mean,count] starting at multiples of w. It is computed from
+        the coarsest rollup with a width dividing w, else from the raw
+        data, which must be numbers."""
+        widths=set(self.rollups)
+        widths.update(width for width,name in self.get_rollups(variable))
+        if not widths:
+          return
+        done=[]
+        with self.batch():
+          for width in sorted(widths):
+            source=variable
+            for prev,name in done:
+              if width%prev==0:
+                source=name
+            a=idxa//width*width
+            b=(idxb//width+1)*width
+            idx,rec=self.get_variable(source,a,b)
+            if source==variable:
+              if not isinstance(rec,np.ndarray) or rec.ndim!=1 or \
+                 rec.dtype.kind not in 'iuf':
+                return
+            last=idx.searchsorted(b)
+            idx,rec=rollup(idx[:last],rec[:last],width)
+            name='%s@%s'%(variable,int(width) if width==int(width) else width)
+            if self.get_varid(name) is None:
+              sql="UPDATE variables SET parent=? WHERE varid=?"
+              self.db.execute(sql,[self.get_varid(variable),
+                                   self.get_varid(name,create=True)])
+            if len(idx)>0:
+              self._store_rollup(name,idx,rec)
+            done.append((width,name))
+    def _store_rollup(self,name,idx,rec):
+        """Store the buckets idx,rec of a rollup. The last bucket, still
+        open, is kept in a page of its own, so that the next stores replace
+        a one record page, and the closed buckets are appended to the
+        pages before it."""
+        tail=self.get_tail(name)
+        if tail is not None and idx[-1]<=tail.idxb and \
+           not (tail.count==1 and idx[-1]==tail.idxb):
+          self._store_variable(name,idx,rec,False)
+          return
+        if tail is not None and tail.count==1:
+          if tail.idxb<idx[0]:
+            # the bucket of the tail page was closed before these ones
+            tidx,trec=self.read_page(tail)
+            idx=concatenate([tidx,idx]);rec=concatenate([trec,rec])
+          self.delete_page(tail)
+        if len(idx)>1:
+          self._store_variable(name,idx[:-1],rec[:-1],False)
+        self.store_page(name,idx[-1:],rec[-1:])
+    def select_rollup(self,variable,idxa=None,idxb=None,
+                      resolution=None,maxpoints=None):
+        """Return the width and name of the rollup of variable for
+        get_variable, (0,variable) for the raw data"""
+        best=(0,variable)
+        levels=self.get_rollups(variable)
+        if resolution is not None:
+          for width,name in levels:
+            if width<=resolution:
+              best=(width,name)
+          return best
+        if self.count(variable,idxa,idxb)<=maxpoints:
+          return best
+        for width,name in levels:
+          best=(width,name)
+          a=idxa//width*width if idxa is not None else None
+          if self.count(name,a,idxb)<=maxpoints:
+            break
+        return best
+    def _merge_tail(self,variable,maxpagesize):
+        """Merge the small pages at the end of variable once one more page
+        like the last one would not fit, as pages in segments cannot grow
+        in place"""
+        sql="""SELECT pageid,recsize FROM pages WHERE varid=?
+               AND deleted IS NULL ORDER BY idxb DESC"""
+        cur=self.db.execute(sql,[self.get_varid(variable)])
+        acc=0;tomerge=[];last=0
+        for pageid,recsize in cur:
+          if acc+recsize>maxpagesize:
+            break
+          acc+=recsize
+          last=last or recsize
+          tomerge.append(pageid)
+        cur.close()
+        if len(tomerge)>1 and acc+last>maxpagesize:
+          pages=[self.get_page(pageid) for pageid in tomerge[::-1]]
+          self.merge_pages(variable,pages)
     def merge_page(self,variable,page,idx,rec):
-       pidx,prec=page.get_all()
+       pidx,prec=self.read_page(page)
        nidx,nrec=merge(pidx,prec,idx,rec)
-       self.store_page(variable,nidx,nrec,commit=False)
-       self.delete_page(page)
+       with self.batch():
+         self.store_page(variable,nidx,nrec)
+         self.delete_page(page)
     def search(self,searchexp="%"):
        cur=self.db.cursor()
-       sql="""SELECT DISTINCT name FROM pages WHERE name LIKE ?"""
+       sql="""SELECT name FROM variables WHERE name LIKE ? AND parent IS NULL
+                AND EXISTS
+                (SELECT 1 FROM pages WHERE pages.varid=variables.varid)"""
        res=cur.execute(sql,[str(searchexp)]).fetchall()
        return [rr[0] for rr in res]
     def get_lim(self,variable,idxa=None,idxb=None):
        cur=self.db.cursor()
+       varid=self.get_varid(variable)
+       # sqlite stores numpy scalars as blobs
+       if hasattr(idxa,'item'):
+         idxa=idxa.item()
+       if hasattr(idxb,'item'):
+         idxb=idxb.item()
        if idxa is None:
-         sql="""SELECT MIN(idxa) FROM PAGES WHERE name==?"""
-         idxa=cur.execute(sql,[variable]).fetchone()[0]
+         sql="""SELECT MIN(idxa) FROM pages WHERE varid=?"""
+         idxa=cur.execute(sql,[varid]).fetchone()[0]
        if idxb is None:
-         sql="""SELECT MAX(idxb) FROM PAGES WHERE name==?"""
-         idxb=cur.execute(sql,[variable]).fetchone()[0]
+         sql="""SELECT MAX(idxb) FROM pages WHERE varid=?"""
+         idxb=cur.execute(sql,[varid]).fetchone()[0]
        return idxa,idxb
     def rebalance(self,variables,maxpagesize):
        for variable in self.search(variables):
           self.rebalance_variable(variable,maxpagesize)
     def rebalance_variable(self,variable,maxpagesize):
-       print("Rebalance %s"%variable)
-       acc=0; tomerge=[]
-       for pagedata in self.get_pages(variable):
-           page=Page(self.pagedir,*pagedata)
-           if acc!=0 or page.recsize<maxpagesize/2:
+       pages=[Page(self.pagedir,*res) for res in self.get_pages(variable)]
+       self._rebalance_pages(variable,pages,maxpagesize)
+       return self
+    def rebalance_range(self,variable,idxa,idxb,maxpagesize):
+       """Rebalance only the pages overlapping [idxa,idxb] and the pages
+       right before and after them"""
+       before,after=self.get_neighbours(variable,idxa,idxb)
+       pages=before+self.get_pages(variable,idxa,idxb)+after
+       pages=[Page(self.pagedir,*res) for res in pages]
+       self._rebalance_pages(variable,pages,maxpagesize)
+       return self
+    def get_neighbours(self,variable,idxa,idxb):
+       """Return the lists of the page ending before idxa and of the page
+       starting after idxb, empty if there are none"""
+       varid=self.get_varid(variable)
+       if varid is None:
+         return [],[]
+       if hasattr(idxa,'item'):
+         idxa=idxa.item()
+       if hasattr(idxb,'item'):
+         idxb=idxb.item()
+       cur=self.db.cursor()
+       sql="""SELECT %s FROM pages WHERE varid=? AND idxb<?
+              AND deleted IS NULL ORDER BY idxb DESC LIMIT 1"""%page_columns
+       before=list(cur.execute(sql,[varid,idxa]))
+       sql="""SELECT %s FROM pages WHERE varid=? AND idxa>?
+              AND deleted IS NULL ORDER BY idxa LIMIT 1"""%page_columns
+       after=list(cur.execute(sql,[varid,idxb]))
+       return before,after
+    def _rebalance_pages(self,variable,pages,maxpagesize):
+       """Merge runs of consecutive pages up to maxpagesize bytes"""
+       acc=0; tomerge=[]; merged=0
+       for page in pages+[None]:
+           if page is None or acc+page.recsize>maxpagesize:
+             if len(tomerge)>1:
+               self.merge_pages(variable,tomerge)
+               merged+=len(tomerge)
+             acc=0; tomerge=[]
+           if page is not None:
              acc+=page.recsize
              tomerge.append(page)
-             if acc> maxpagesize:
-               self.merge_pages(variable,tomerge)
-               acc=0; tomerge=[]
-       if len(tomerge)>1:
-           self.merge_pages(variable,tomerge)
-       return self
+       return merged
+    def compact(self,variables='%',maxpagesize=None,progress=None):
+       """Rebalance all the pages of the variables matching the pattern,
+       one transaction per variable. progress(done,total,variable) is
+       called after each variable. Return the number of merged pages."""
+       if maxpagesize is None:
+         maxpagesize=self.maxpagesize
+       if isstr(variables):
+         variables=self.search(variables)
+       merged=0
+       for ii,variable in enumerate(variables):
+         with self.batch():
+           pages=[Page(self.pagedir,*res) for res in self.get_pages(variable)]
+           merged+=self._rebalance_pages(variable,pages,maxpagesize)
+         if progress is not None:
+           progress(ii+1,len(variables),variable)
+       return merged
+    def compact_segments(self,minfill=0.5):
+       """Copy the pages of the segment files with less than minfill of
+       their bytes in use to the current segment, then remove the old
+       files. Return the number of bytes reclaimed."""
+       if self._batch:
+         raise ValueError("compact_segments cannot run inside a batch")
+       reclaimed=0
+       with self.batch():
+         # under the write lock: other writers append only to the last
+         # segment, which is never compacted
+         sql="""SELECT segment,SUM(disksize) FROM pages
+                WHERE segment IS NOT NULL GROUP BY segment"""
+         used=dict(self.db.execute(sql).fetchall())
+         files=self._segment_files()
+         self._segment=max([0]+list(files))
+         todo=[]
+         for segment,fname in sorted(files.items()):
+           size=os.path.getsize(fname)
+           if segment!=self._segment and used.get(segment,0)<minfill*size:
+             todo.append((segment,fname,size))
+         for segment,fname,size in todo:
+           sql="SELECT pageid,segoffset,disksize FROM pages WHERE segment=?"
+           rows=self.db.execute(sql,[segment]).fetchall()
+           for pageid,segoffset,disksize in rows:
+             data=read_bytes(fname,segoffset,disksize)
+             newsegment,newoffset=self._append_segment(data)
+             sql="UPDATE pages SET segment=?,segoffset=? WHERE pageid=?"
+             self.db.execute(sql,[newsegment,newoffset,pageid])
+           reclaimed+=size-used.get(segment,0)
+       for segment,fname,size in todo:
+         os.unlink(fname)
+       return reclaimed
     def get_info(self,variable=None):
        cur=self.db.cursor()
-       suf='FROM pages'
+       suf=' FROM pages';args=[]
        if variable is not None:
-         suf+=' WHERE name=="%s"'%variable
+         suf+=' WHERE varid==?';args=[self.get_varid(variable)]
          out=''
        else:
-         nvars=cur.execute("SELECT COUNT(DISTINCT name) FROM pages").fetchone()[0]
+         nvars=cur.execute("SELECT COUNT(DISTINCT varid) FROM pages").fetchone()[0]
          out='%s variables, '%(human_readable(nvars))
-       npages=cur.execute("SELECT COUNT(*)"+suf).fetchone()[0]
-       nrecords=cur.execute("SELECT SUM(count)"+suf).fetchone()[0]
-       nsize=cur.execute("SELECT SUM(recsize)"+suf).fetchone()[0]
-       asize=cur.execute("SELECT AVG(recsize)"+suf).fetchone()[0]
+       sql="SELECT COUNT(*),SUM(count),SUM(recsize),AVG(recsize)"+suf
+       npages,nrecords,nsize,asize=cur.execute(sql,args).fetchone()
        if npages>0:
          data=tuple(map(human_readable,(npages,nrecords,nsize,asize)))
          out+=("%s pages, %s records, %sB total, %sB/page"%data)
+       # raw size of index and records of the pages with known disk size
+       sql="""SELECT SUM(recsize+count*CAST(substr(idxtype,3) AS INTEGER)),
+                       SUM(disksize)"""+suf
+       sql+=' AND' if variable is not None else ' WHERE'
+       sql+=' disksize IS NOT NULL'
+       rawsize,disksize=cur.execute(sql,args).fetchone()
+       if disksize:
+         data=(human_readable(disksize),rawsize/float(disksize))
+         out+=(", %sB on disk, compression ratio %.2f"%data)
+       if variable is None:
+         data=(len(self._cache),human_readable(self._cachebytes),
+               self.cache_hits,self.cache_misses,self.cache_evictions)
+         out+=("\ncache: %d pages, %sB, %d hits, %d misses, "
+               "%d evictions"%data)
        return out
     def merge_pages(self,variable,pages):
-        print("Merging %d pages"%len(pages))
-        out=[page.get_all() for page in pages]
+        out=[self.read_page(page) for page in pages]
         idxlist,reclist=zip(*out)
-        self.store_page(variable,concatenate(idxlist),concatenate(reclist))
-        for page in pages:
-          self.delete_page(page)
+        with self.batch():
+          self.store_page(variable,concatenate(idxlist),concatenate(reclist))
+          for page in pages:
+            self.delete_page(page)
     def split_pages(self,variable,maxsize):
        for pagedata in self.get_pages(variable):
            page=Page(self.pagedir,*pagedata)
@@ -340,16 +1438,16 @@ class PageStore(object):
                self.store_page(variable,idx[i:i+step],rec[i:i+step])
              self.delete_page(page)
     def prune_delete_pages(self,timestamp=None):
-        cur=self.db.cursor()
+        """Remove the pages marked as deleted before timestamp ('now' by
+        default), with their files"""
         if timestamp is None:
             timestamp='now'
-        sql="""SELECT pageid,idxtype,count,idxa,idxb,
-                      rectype,reclen,recsize,comp,checksum
-               FROM pages WHERE
-               deleted < strftime('%s',?)
-               """
-        pages=list(cur.execute(sql,[timestamp]))
-        for pagedata in pages:
-            page=Page(self.pagedir,*pagedata)
-            self.delete_page(page)
+        with self.batch():
+            sql="""SELECT %s FROM pages WHERE
+                   deleted <= strftime('%%s',?)
+                   """%page_columns
+            pages=list(self.db.execute(sql,[timestamp]))
+            for pagedata in pages:
+                page=Page(self.pagedir,*pagedata)
+                self.delete_page(page,keep=False)
 
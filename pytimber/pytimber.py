@@ -35,6 +35,9 @@ Authors:
 import os
 import time
 import datetime
+import tempfile
+import threading
+import weakref
 import six
 import logging
 
@@ -46,19 +49,107 @@ except ImportError:
         Exporting data from the logging database will not be
         available!""")
 import numpy as np
-from collections import namedtuple
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-Stat = namedtuple(
-    'Stat',
-    ['MinTstamp', 'MaxTstamp', 'ValueCount',
-     'MinValue', 'MaxValue', 'AvgValue',
-     'StandardDeviationValue']
-)
+from .decimate import MinMaxDecimator, methods as decimationMethods
+from .localstats import Stat
 
 if six.PY3:
     long = int
 
 
+def narrowestDtype(data, chunksize=2 ** 20):
+    """Return the smallest numeric dtype able to represent all the values of
+    data exactly.
+
+    Integer valued floats give integer dtypes, other floats give float32 if
+    no precision is lost. The data is scanned in chunks, so that memory
+    mapped arrays are never loaded at once.
+    """
+    dtype = data.dtype
+    if data.size == 0 or dtype.kind not in 'iuf':
+        return dtype
+    vmin, vmax = None, None
+    integral = True
+    single = dtype.kind == 'f' and dtype.itemsize > 4
+    flat = data.reshape(-1)
+    for i in range(0, flat.size, chunksize):
+        chunk = flat[i:i + chunksize]
+        cmin, cmax = chunk.min(), chunk.max()
+        if dtype.kind == 'f':
+            integral = integral and np.isfinite(cmin) and \
+                np.isfinite(cmax) and (np.floor(chunk) == chunk).all()
+            single = single and \
+                ((chunk.astype(np.float32) == chunk) | np.isnan(chunk)).all()
+        vmin = cmin if vmin is None else min(vmin, cmin)
+        vmax = cmax if vmax is None else max(vmax, cmax)
+    if integral and -2 ** 63 <= vmin and vmax < 2 ** 63:
+        for itype in (np.int8, np.int16, np.int32, np.int64):
+            info = np.iinfo(itype)
+            if info.min <= vmin and vmax <= info.max:
+                if np.dtype(itype).itemsize < dtype.itemsize:
+                    return np.dtype(itype)
+                break
+    if single:
+        return np.dtype(np.float32)
+    return dtype
+
+
+def narrowDtype(data):
+    """Return data converted to the smallest numeric dtype able to
+    represent all its values exactly, see narrowestDtype.
+    """
+    if not isinstance(data, np.ndarray):
+        return data
+    dtype = narrowestDtype(data)
+    if dtype != data.dtype:
+        return data.astype(dtype)
+    return data
+
+
+def removeSpill(path, log):
+    """Remove the temporary file of a spilled array."""
+    try:
+        os.unlink(path)
+    except OSError:
+        log.warning('Could not remove {0}'.format(path))
+
+
+def selectRecords(data, mask):
+    """Return the records of data where mask is True, data being an array
+    or a list of records (strings or vectors of different lengths)."""
+    if isinstance(data, np.ndarray):
+        return data[mask]
+    return [data[i] for i in np.flatnonzero(mask)]
+
+
+def padNames(rows):
+    """Return the lists or arrays of names rows as a 2-D array padded
+    with ''."""
+    rows = [np.asarray(row, dtype=str) for row in rows]
+    width = max([len(row) for row in rows] + [0])
+    itemsize = max([row.dtype.itemsize for row in rows] + [1])
+    names = np.zeros((len(rows), width),
+                     dtype=(str, itemsize // np.dtype((str, 1)).itemsize))
+    for i, row in enumerate(rows):
+        names[i, :len(row)] = row
+    return names
+
+
+def metaDataIndex(ts, timestamps):
+    """Return the index of the metadata row valid at each of timestamps, row
+    i being valid from ts[i], -1 before ts[0]."""
+    return np.searchsorted(ts, timestamps, side='right') - 1
+
+
+def metaDataAt(ts, rows, timestamps):
+    """Return the element of rows valid at each of timestamps, None before
+    ts[0], see metaDataIndex."""
+    idx = metaDataIndex(ts, timestamps)
+    return [rows[i] if i >= 0 else None for i in np.atleast_1d(idx)]
+
+
 # Documentation CALS API
 # http://abwww.cern.ch/ap/dist/accsoft/cals/accsoft-cals-extr-client/PRO/build/docs/api/
 
@@ -68,6 +159,13 @@ class LoggingDB(object):
     except NameError:
         print('ERROR: jpype is note defined!')
 
+    # number of variables kept in the getMetaData cache
+    metadatacache = 128
+
+    # services shared by all instances, keyed by (appid, clientid, source)
+    _services = {}
+    _services_lock = threading.Lock()
+
     def _read_conf_file(self, conf_filename):
         custom_conf={}
         try:
@@ -88,19 +186,15 @@ class LoggingDB(object):
             self._log.setLevel(loglevel)
 
         # Start JVM
-        mgr = cmmnbuild_dep_manager.Manager('pytimber', logging.WARNING)
-        mgr.start_jpype_jvm()
-
-        # log4j config
-        null = jpype.JPackage('org').apache.log4j.varia.NullAppender()
-        jpype.JPackage('org').apache.log4j.BasicConfigurator.configure(null)
-
-        # Data source preferences
-        DataLocPrefs = (jpype.JPackage('cern').accsoft.cals.extr.domain
-                        .core.datasource.DataLocationPreferences)
-        loc = {'mdb': DataLocPrefs.MDB_PRO,
-               'ldb': DataLocPrefs.LDB_PRO,
-               'all': DataLocPrefs.MDB_AND_LDB_PRO}[source]
+        if not jpype.isJVMStarted():
+            mgr = cmmnbuild_dep_manager.Manager('pytimber', logging.WARNING)
+            mgr.start_jpype_jvm()
+
+            # log4j config
+            null = jpype.JPackage('org').apache.log4j.varia.NullAppender()
+            jpype.JPackage('org').apache.log4j.BasicConfigurator.configure(null)
+        elif jpype.isThreadAttachedToJVM() == 0:
+            jpype.attachThreadToJVM()
 
         if appid=='LHC_MD_ABP_ANALYSIS' or clientid=='BEAM PHYSICS':
             custom_conf=self._read_conf_file(conf_filename)
@@ -117,14 +211,46 @@ class LoggingDB(object):
                  "a configuration file (default name: 'configuration.properties')"
                  "in order to suppress this message.")
 
-        ServiceBuilder = (jpype.JPackage('cern').accsoft.cals.extr.client
-                          .service.ServiceBuilder)
-        builder = ServiceBuilder.getInstance(appid, clientid, loc)
-        self._builder = builder
-        self._md = builder.createMetaService()
-        self._ts = builder.createTimeseriesService()
-        self._FillService = FillService = builder.createLHCFillService()
+        self._metadata = OrderedDict()
+        self.setIdentity(appid, clientid, source)
+
+    @classmethod
+    def _getServices(cls, appid, clientid, source):
+        """Return the (builder, meta, timeseries, fill) services for an
+        application identity and a data source, creating them only the first
+        time they are requested in the process."""
+        key = (appid, clientid, source)
+        with cls._services_lock:
+            if key not in cls._services:
+                # Data source preferences
+                DataLocPrefs = (jpype.JPackage('cern').accsoft.cals.extr
+                                .domain.core.datasource.DataLocationPreferences)
+                loc = {'mdb': DataLocPrefs.MDB_PRO,
+                       'ldb': DataLocPrefs.LDB_PRO,
+                       'all': DataLocPrefs.MDB_AND_LDB_PRO}[source]
+                ServiceBuilder = (jpype.JPackage('cern').accsoft.cals.extr
+                                  .client.service.ServiceBuilder)
+                builder = ServiceBuilder.getInstance(appid, clientid, loc)
+                cls._services[key] = (builder,
+                                      builder.createMetaService(),
+                                      builder.createTimeseriesService(),
+                                      builder.createLHCFillService())
+            return cls._services[key]
+
+    def setIdentity(self, appid, clientid, source=None):
+        """Use the services of another application identity and/or data
+        source ('mdb', 'ldb' or 'all'). Services are shared between all the
+        LoggingDB instances of the process, so switching back and forth
+        between identities does not create new services."""
+        if source is None:
+            source = self._source
+        services = self._getServices(appid, clientid, source)
+        if source != getattr(self, '_source', None):
+            self._metadata.clear()
+        self._builder, self._md, self._ts, self._FillService = services
+        self._appid, self._clientid, self._source = appid, clientid, source
         self.tree = Hierarchy('root', None, None, self._md)
+        return self
 
     def toTimestamp(self, t):
         Timestamp = jpype.java.sql.Timestamp
@@ -146,6 +272,8 @@ class LoggingDB(object):
     def fromTimestamp(self, ts, unixtime):
         if ts is None:
             return None
+        elif unixtime == 'ns':
+            return (ts.fastTime // 1000) * 1000000000 + ts.getNanos()
         else:
             t = ts.fastTime / 1000.0 + ts.getNanos() / 1.0e9
             if unixtime:
@@ -153,6 +281,57 @@ class LoggingDB(object):
             else:
                 return datetime.datetime.fromtimestamp(t)
 
+    def toTimestamps(self, values):
+        """Convert an array of unix times in seconds or of numpy datetime64
+        to a java Timestamp[], keeping the nanoseconds. Other values are
+        converted one by one with toTimestamp.
+        """
+        Timestamp = jpype.java.sql.Timestamp
+        arr = np.asarray(values)
+        out = jpype.JArray(Timestamp)(len(arr))
+        if arr.dtype.kind == 'M':
+            ns = arr.astype('datetime64[ns]').astype(np.int64)
+        elif arr.dtype.kind in 'iuf':
+            sec = np.floor(arr)
+            ns = (sec.astype(np.int64) * 1000000000 +
+                  ((arr - sec) * 1e9).astype(np.int64))
+        else:
+            for i, t in enumerate(values):
+                out[i] = self.toTimestamp(t)
+            return out
+        secs = ns // 1000000000
+        nanos = ns - secs * 1000000000
+        for i, (ms, nn) in enumerate(zip((secs * 1000).tolist(),
+                                         nanos.tolist())):
+            ts = Timestamp(long(ms))
+            ts.setNanos(nn)
+            out[i] = ts
+        return out
+
+    def fromTimestamps(self, tss, unixtime=True):
+        """Convert a sequence of java Timestamps to an array of float unix
+        times (unixtime=True), of int64 unix times in nanoseconds
+        (unixtime='ns') or of datetime objects (unixtime=False).
+
+        None values give NaN, the minimum int64 or None respectively.
+        """
+        tss = list(tss)
+        missing = np.array([ts is None for ts in tss], dtype=bool)
+        secs = np.array([0 if ts is None else ts.fastTime // 1000
+                         for ts in tss], dtype=np.int64)
+        nanos = np.array([0 if ts is None else ts.getNanos()
+                          for ts in tss], dtype=np.int64)
+        if unixtime == 'ns':
+            out = secs * 1000000000 + nanos
+            out[missing] = np.iinfo(np.int64).min
+            return out
+        out = secs + nanos / 1.0e9
+        out[missing] = np.nan
+        if not unixtime:
+            out = np.array([None if miss else datetime.datetime.fromtimestamp(t)
+                            for t, miss in zip(out, missing)], dtype=object)
+        return out
+
     def toStringList(self, myArray):
         myList = jpype.java.util.ArrayList()
         for s in myArray:
@@ -225,7 +404,96 @@ class LoggingDB(object):
             variables = None
         return variables
 
-    def processDataset(self, dataset, datatype, unixtime):
+    def applyDtype(self, name, data, dtype, spill=None):
+        """Convert data of variable name according to the dtype policy.
+
+        dtype can be None (no conversion), 'auto' (lossless narrowing, see
+        narrowestDtype), a numpy dtype or a dictionary {name: dtype} of the
+        previous. With a memory budget in spill, or for memory mapped data,
+        the converted copy is allocated by _allocate and filled chunk by
+        chunk.
+        """
+        if isinstance(dtype, dict):
+            dtype = dtype.get(name)
+        if dtype is None or not isinstance(data, np.ndarray) \
+                or data.dtype.kind not in 'biuf':
+            return data
+        if isinstance(dtype, six.string_types) and dtype == 'auto':
+            dtype = narrowestDtype(data)
+        dtype = np.dtype(dtype)
+        if dtype == data.dtype:
+            return data
+        if spill is not None or isinstance(data, np.memmap):
+            out = self._allocate(data.shape, dtype, spill)
+            for i in range(0, len(data), 4096):
+                out[i:i + 4096] = data[i:i + 4096]
+            return out
+        return data.astype(dtype)
+
+    def _allocate(self, shape, dtype, spill=None):
+        """Allocate an array of the given shape and dtype.
+
+        If spill is a dictionary {'budget': bytes, 'dir': path} and the array
+        does not fit in the remaining budget, the array is a memmap of a
+        temporary file in dir, which is removed when the array is released.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if spill is None or nbytes == 0 or nbytes <= spill['budget']:
+            if spill is not None:
+                spill['budget'] -= nbytes
+            return np.empty(shape, dtype=dtype)
+        fd, path = tempfile.mkstemp(prefix='pytimber', suffix='.dat',
+                                    dir=spill.get('dir'))
+        os.close(fd)
+        self._log.info('Spilling {0} bytes to {1}'.format(nbytes, path))
+        out = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        try:
+            os.unlink(path)
+        except OSError:
+            # mapped files cannot be removed on Windows, the file is
+            # removed once the map is closed
+            weakref.finalize(out._mmap, removeSpill, path, self._log)
+        return out
+
+    def _toArray(self, src, dtype, spill=None, vector=False,
+                 chunksize=4096):
+        """Convert a java array, or a java array of arrays if vector is True,
+        to a numpy array filled chunk by chunk. Vectors of different lengths
+        give an array of arrays.
+        """
+        n = len(src)
+        if vector:
+            lengths = set(len(row) for row in src)
+            if len(lengths) > 1:
+                out = np.empty(n, dtype=object)
+                for i, row in enumerate(src):
+                    out[i] = np.array(row[:], dtype=dtype)
+                return out
+            out = self._allocate((n, lengths.pop()), dtype, spill)
+            for i in range(0, n, chunksize):
+                out[i:i + chunksize] = [row[:] for row in
+                                        src[i:i + chunksize]]
+        else:
+            out = self._allocate((n,), dtype, spill)
+            for i in range(0, n, chunksize):
+                out[i:i + chunksize] = src[i:i + chunksize]
+        return out
+
+    def processDataset(self, dataset, datatype, unixtime, spill=None,
+                       max_points=None, decimation='minmax'):
+        """Convert a dataset to a (timestamps, values) tuple of arrays.
+
+        Timestamps are float unix times if unixtime is True, int64 unix
+        times in nanoseconds if unixtime is 'ns', datetime objects otherwise.
+
+        Numeric arrays exceeding the memory budget in spill are returned as
+        temporary memmaps, see _allocate.
+
+        Scalar numeric data with more than max_points samples is decimated
+        with the 'minmax' or 'lttb' method, see pytimber.decimate. The
+        'minmax' method is applied chunk by chunk while converting.
+        """
         spi = (jpype.JPackage('cern').accsoft.cals.extr.domain.core
                .timeseriesdata.spi)
 
@@ -236,14 +504,32 @@ class LoggingDB(object):
             dataset = new_ds
 
         if dataset.isEmpty():
-            return (np.array([], dtype=float), np.array([], dtype=float))
+            tsdtype = np.int64 if unixtime == 'ns' else float
+            return (np.array([], dtype=tsdtype), np.array([], dtype=float))
 
         PrimitiveDataSets = jpype.JPackage('cern').lhc.commons.cals.PrimitiveDataSets
-        timestamps = np.array(PrimitiveDataSets.unixTimestamps(dataset)[:], dtype=float)
-        if not unixtime:
-            timestamps = np.array([datetime.datetime.fromtimestamp(t) for t in timestamps])
-
         dataclass = PrimitiveDataSets.dataClass(dataset)
+        if max_points is not None and decimation == 'minmax' \
+                and datatype == 'NUMERIC' and unixtime != 'ns' \
+                and dataset.size() > max_points:
+            if dataclass == spi.NumericDoubleData:
+                values = PrimitiveDataSets.doubleData(dataset)
+            elif dataclass == spi.NumericLongData:
+                values = PrimitiveDataSets.longData(dataset)
+            else:
+                values = None
+            if values is not None:
+                return self._decimateChunks(
+                    PrimitiveDataSets.unixTimestamps(dataset), values,
+                    max_points, unixtime)
+
+        if unixtime == 'ns':
+            timestamps = self.fromTimestamps(
+                [data.getStamp() for data in dataset], 'ns')
+        else:
+            timestamps = self._toArray(PrimitiveDataSets.unixTimestamps(dataset),
+                                       float, spill)
+
         if datatype == 'MATRIXNUMERIC':
             if dataclass == spi.MatrixNumericDoubleData:
                 data = np.array([[np.array(a[:], dtype=float) for a in matrix] for matrix in
@@ -257,9 +543,11 @@ class LoggingDB(object):
                 data = [t for t in dataset]
         elif datatype == 'VECTORNUMERIC':
             if dataclass == spi.VectorNumericDoubleData:
-                data = np.array([np.array(a[:], dtype=float) for a in PrimitiveDataSets.doubleVectorData(dataset)])
+                data = self._toArray(PrimitiveDataSets.doubleVectorData(dataset),
+                                     float, spill, vector=True)
             elif dataclass == spi.VectorNumericLongData:
-                data = np.array([np.array(a[:], dtype=int) for a in PrimitiveDataSets.longVectorData(dataset)])
+                data = self._toArray(PrimitiveDataSets.longVectorData(dataset),
+                                     int, spill, vector=True)
             else:
                 self._log.warning('Unsupported datatype, returning the '
                                   'java object')
@@ -268,9 +556,11 @@ class LoggingDB(object):
             data = np.array([np.array(a[:], dtype='U') for a in PrimitiveDataSets.stringVectorData(dataset)])
         elif datatype == 'NUMERIC':
             if dataclass == spi.NumericDoubleData:
-                data = np.array(PrimitiveDataSets.doubleData(dataset)[:], dtype=float)
+                data = self._toArray(PrimitiveDataSets.doubleData(dataset),
+                                     float, spill)
             elif dataclass == spi.NumericLongData:
-                data = np.array(PrimitiveDataSets.longData(dataset)[:], dtype=int)
+                data = self._toArray(PrimitiveDataSets.longData(dataset),
+                                     int, spill)
             else:
                 self._log.warning('Unsupported datatype, returning the '
                                   'java object')
@@ -283,11 +573,36 @@ class LoggingDB(object):
             self._log.warning('Unsupported datatype, returning the '
                               'java object')
             data = [t for t in dataset]
+        if max_points is not None and isinstance(data, np.ndarray) \
+                and data.ndim == 1 and data.dtype.kind in 'iuf' \
+                and len(data) > max_points:
+            idx = decimationMethods[decimation](timestamps, data, max_points)
+            timestamps, data = timestamps[idx], data[idx]
+        if not unixtime:
+            timestamps = np.array([datetime.datetime.fromtimestamp(t) for t in timestamps])
+        return (timestamps, data)
+
+    def _decimateChunks(self, stamps, values, max_points, unixtime,
+                        chunksize=65536):
+        """Decimate java arrays of unix timestamps and values with the
+        'minmax' method, converting chunksize samples at a time.
+        """
+        n = len(stamps)
+        dec = MinMaxDecimator(stamps[0], stamps[n - 1], max_points)
+        for i in range(0, n, chunksize):
+            dec.add(np.array(stamps[i:i + chunksize], dtype=float),
+                    np.array(values[i:i + chunksize]))
+        timestamps, data = dec.result()
+        if not unixtime:
+            timestamps = np.array([datetime.datetime.fromtimestamp(t) for t in timestamps])
         return (timestamps, data)
 
     def getAligned(self, pattern_or_list, t1, t2,
-                   fundamental=None, master=None, unixtime=True):
-        """Get data aligned to a variable"""
+                   fundamental=None, master=None, unixtime=True, dtype=None):
+        """Get data aligned to a variable.
+
+        See get() for the meaning of unixtime and dtype.
+        """
         ts1 = self.toTimestamp(t1)
         ts2 = self.toTimestamp(t2)
         out = {}
@@ -350,6 +665,8 @@ class LoggingDB(object):
             master_ds.getVariableDataType().toString(),
             unixtime
         )
+        out[master_name] = self.applyDtype(master_name, out[master_name],
+                                           dtype)
 
         # Acquire aligned data based on master dataset timestamps
         for v in variables:
@@ -365,6 +682,7 @@ class LoggingDB(object):
             out[v] = self.processDataset(
                 res, res.getVariableDataType().toString(), unixtime
             )[1]
+            out[v] = self.applyDtype(v, out[v], dtype)
         return out
 
     def searchFundamental(self, fundamental, t1, t2=None):
@@ -402,20 +720,24 @@ class LoggingDB(object):
         )
 
         out = {}
-        for stat in data.getStatisticsList():
-            count = stat.getValueCount()
-            if count > 0:
-                s = Stat(
-                    self.fromTimestamp(stat.getMinTstamp(), unixtime),
-                    self.fromTimestamp(stat.getMaxTstamp(), unixtime),
-                    int(count),
-                    stat.getMinValue().doubleValue(),
-                    stat.getMaxValue().doubleValue(),
-                    stat.getAvgValue().doubleValue(),
-                    stat.getStandardDeviationValue().doubleValue()
-                )
+        stats = [stat for stat in data.getStatisticsList()
+                 if stat.getValueCount() > 0]
+        tmin = self.fromTimestamps([stat.getMinTstamp() for stat in stats],
+                                   unixtime).tolist()
+        tmax = self.fromTimestamps([stat.getMaxTstamp() for stat in stats],
+                                   unixtime).tolist()
+        for stat, t1, t2 in zip(stats, tmin, tmax):
+            s = Stat(
+                t1,
+                t2,
+                int(stat.getValueCount()),
+                stat.getMinValue().doubleValue(),
+                stat.getMaxValue().doubleValue(),
+                stat.getAvgValue().doubleValue(),
+                stat.getStandardDeviationValue().doubleValue()
+            )
 
-                out[stat.getVariableName()] = s
+            out[stat.getVariableName()] = s
 
         return out
 
@@ -439,7 +761,9 @@ class LoggingDB(object):
     #            return self._ts.getJVMHeapSizeEstimationForDataInTimeWindow(v,ts1,ts2,None,None)
 
     def get(self, pattern_or_list, t1, t2=None,
-            fundamental=None, unixtime=True):
+            fundamental=None, unixtime=True, dtype=None,
+            membudget=None, spilldir=None,
+            max_points=None, decimation='minmax'):
         """Query the database for a list of variables or for variables whose
         name matches a pattern (string) in a time window from t1 to t2.
 
@@ -450,9 +774,29 @@ class LoggingDB(object):
 
         If a fundamental pattern is provided, the end of the time window as to
         be explicitely provided.
+
+        Timestamps are returned as float unix times if unixtime is True, as
+        int64 unix times in nanoseconds if unixtime is 'ns' and as datetime
+        objects if unixtime is False.
+
+        The values are converted according to dtype: None keeps the native
+        float64 or int64 arrays, 'auto' narrows them to the smallest dtype
+        without loss (e.g. int64 to int16), a numpy dtype converts all the
+        values, a dictionary {variable: dtype} selects per variable.
+
+        If membudget is given (in bytes), the arrays that do not fit in what
+        remains of the budget are written chunk by chunk in temporary files
+        (in spilldir or the default temporary directory) and returned as
+        numpy memmaps.
+
+        If max_points is given, scalar numeric variables with more samples
+        are reduced to about max_points samples for display, keeping the
+        minimum and maximum of each time bucket (decimation='minmax') or
+        using the Largest-Triangle-Three-Buckets method (decimation='lttb').
         """
 
         ts1 = self.toTimestamp(t1)
+        ts2 = None
         if t2 not in ['last', 'next', None]:
             ts2 = self.toTimestamp(t2)
         out = {}
@@ -474,56 +818,218 @@ class LoggingDB(object):
             self._log.warning('Unsupported: if filtering by fundamentals '
                               'you must provide a correct time window')
             return {}
+        fundamentals = None
         if fundamental is not None:
             fundamentals = self.getFundamentals(ts1, ts2, fundamental)
             if fundamentals is None:
                 return {}
 
         # Acquire
+        spill = None
+        if membudget is not None:
+            spill = {'budget': membudget, 'dir': spilldir}
         for v in variables:
             jvar = variables.getVariable(v)
-            if t2 is None or t2 == 'last':
-                res = [
-                    self._ts.getLastDataPriorToTimestampWithinDefaultInterval(
-                        jvar, ts1
-                    )
-                ]
-                if res[0] is None:
-                    res = []
-                    datatype = None
-                else:
-                    datatype = res[0].getVariableDataType().toString()
-                    self._log.info('Retrieved {0} values for {1}'.format(
-                        1, jvar.getVariableName()
-                    ))
-            elif t2 == 'next':
-                res = [
-                    self._ts.getNextDataAfterTimestampWithinDefaultInterval(
-                        jvar, ts1
-                    )
-                ]
-                if res[0] is None:
-                    res = []
-                    datatype = None
-                else:
-                    datatype = res[0].getVariableDataType().toString()
-                    self._log.info('Retrieved {0} values for {1}'.format(
-                        1, jvar.getVariableName()
-                    ))
+            res, datatype = self._getVariableData(jvar, ts1, t2, ts2,
+                                                  fundamentals)
+            ts, data = self.processDataset(res, datatype, unixtime, spill,
+                                           max_points, decimation)
+            out[v] = ts, self.applyDtype(v, data, dtype, spill)
+        return out
+
+    def _getVariableData(self, jvar, ts1, t2, ts2, fundamentals=None):
+        """Acquire the dataset of a single variable, see get()"""
+        if t2 is None or t2 == 'last':
+            res = [
+                self._ts.getLastDataPriorToTimestampWithinDefaultInterval(
+                    jvar, ts1
+                )
+            ]
+            if res[0] is None:
+                res = []
+                datatype = None
             else:
-                if fundamental is not None:
-                    res = self._ts.getDataInTimeWindowFilteredByFundamentals(
-                        jvar, ts1, ts2, fundamentals
-                    )
-                else:
-                    res = self._ts.getDataInTimeWindow(jvar, ts1, ts2)
-                datatype = res.getVariableDataType().toString()
+                datatype = res[0].getVariableDataType().toString()
                 self._log.info('Retrieved {0} values for {1}'.format(
-                    res.size(), jvar.getVariableName()
+                    1, jvar.getVariableName()
                 ))
-            out[v] = self.processDataset(res, datatype, unixtime)
+        elif t2 == 'next':
+            res = [
+                self._ts.getNextDataAfterTimestampWithinDefaultInterval(
+                    jvar, ts1
+                )
+            ]
+            if res[0] is None:
+                res = []
+                datatype = None
+            else:
+                datatype = res[0].getVariableDataType().toString()
+                self._log.info('Retrieved {0} values for {1}'.format(
+                    1, jvar.getVariableName()
+                ))
+        else:
+            res, datatype = self._getWindowData(jvar, ts1, ts2, fundamentals)
+        return res, datatype
+
+    def _getWindowData(self, jvar, ts1, ts2, fundamentals=None):
+        """Acquire the dataset of a single variable from ts1 to ts2"""
+        if fundamentals is not None:
+            res = self._ts.getDataInTimeWindowFilteredByFundamentals(
+                jvar, ts1, ts2, fundamentals
+            )
+        else:
+            res = self._ts.getDataInTimeWindow(jvar, ts1, ts2)
+        datatype = res.getVariableDataType().toString()
+        self._log.info('Retrieved {0} values for {1}'.format(
+            res.size(), jvar.getVariableName()
+        ))
+        return res, datatype
+
+    def getByFills(self, pattern_or_list, fills, mode1=None, mode2=None,
+                   mode1time='startTime', mode2time='endTime',
+                   mode1idx=0, mode2idx=-1, unixtime=True,
+                   maxworkers=4, store=None):
+        """Query the database for a list of variables or for variables whose
+        name matches a pattern (string) for each fill in a list of LHC fills.
+
+        The time window of a fill goes from its start to its end or, if
+        mode1 and/or mode2 are given, from the 'mode1time' of beam mode
+        mode1 to the 'mode2time' of beam mode mode2 (see
+        getIntervalsByLHCModes). Fills can also be given directly as
+        [fill, t1, t2] intervals, as returned by getIntervalsByLHCModes.
+        A window without end, as for an ongoing fill or beam mode, ends now.
+
+        The windows of all the fills are resolved first, then the data is
+        fetched by at most 'maxworkers' concurrent queries. If a PageStore
+        is given in 'store', the data of each fill is stored as soon as it
+        arrives.
+
+        Returns a dictionary {fill: {variable: (timestamps, values)}}.
+        """
+        if isinstance(fills, six.integer_types):
+            fills = [fills]
+
+        # Resolve fill windows
+        windows = []
+        for fill in fills:
+            if isinstance(fill, (list, tuple)):
+                windows.append(tuple(fill))
+                continue
+            data = self.getLHCFillData(int(fill))
+            if data is None:
+                self._log.warning('Fill {0} not found.'.format(fill))
+                continue
+            interval = self._getFillInterval(data, mode1, mode2,
+                                             mode1time, mode2time,
+                                             mode1idx, mode2idx)
+            if interval is None:
+                self._log.warning('Beam modes {0}, {1} not found in '
+                                  'fill {2}.'.format(mode1, mode2, fill))
+                continue
+            windows.append((int(fill),) + interval)
+        for i, (fill, t1, t2) in enumerate(windows):
+            if t2 is None:
+                self._log.info('Fill {0} has no end, reading it up to '
+                               'now.'.format(fill))
+                windows[i] = (fill, t1, time.time())
+
+        # Build variable list
+        variables = self.getVariablesList(pattern_or_list)
+        if len(variables) == 0:
+            self._log.warning('No variables found.')
+            return {}
+        jvars = [(v, variables.getVariable(v)) for v in variables]
+        self._log.info('List of variables to be queried: {0}'.format(
+            ', '.join([v for v, jvar in jvars])))
+
+        # Acquire
+        tss = self.toTimestamps([t for window in windows
+                                 for t in window[1:]])
+        windows = [(window[0], tss[2 * i], tss[2 * i + 1])
+                   for i, window in enumerate(windows)]
+
+        def getFill(window):
+            if jpype.isThreadAttachedToJVM() == 0:
+                jpype.attachThreadToJVM()
+            fill, ts1, ts2 = window
+            data = {}
+            for v, jvar in jvars:
+                res, datatype = self._getWindowData(jvar, ts1, ts2)
+                data[v] = self.processDataset(res, datatype, unixtime)
+            return fill, data
+
+        out = {}
+        pool = ThreadPool(max(1, min(maxworkers, len(windows))))
+        try:
+            for fill, data in pool.imap_unordered(getFill, windows):
+                self._log.info('Retrieved fill {0}'.format(fill))
+                out[fill] = data
+                if store is not None:
+                    store.store(data)
+        finally:
+            pool.terminate()
         return out
 
+    def follow(self, pattern_or_list, t1=None, interval=30, lag=None,
+               count=None):
+        """Follow a list of variables or the variables whose name matches a
+        pattern (string), polling the database every 'interval' seconds.
+
+        Yields after each poll a dictionary {variable: (timestamps, values)}
+        with the samples that were not yielded before. Only the data after
+        the last timestamp seen for each variable is requested, starting
+        from t1 (by default now).
+
+        Samples that reach the database late, with a timestamp at most 'lag'
+        seconds (by default one interval) before the last one seen, are
+        merged into the next delta.
+
+        The generator stops after 'count' polls, if given.
+
+        Example:
+            for delta in ldb.follow('HX:BETASTAR%', interval=30):
+                for name, (t, v) in delta.items():
+                    print(name, t, v)
+        """
+        # Build variable list
+        variables = self.getVariablesList(pattern_or_list)
+        if len(variables) == 0:
+            self._log.warning('No variables found.')
+            return
+        jvars = [(v, variables.getVariable(v)) for v in variables]
+
+        if lag is None:
+            lag = interval
+        if t1 is None:
+            t1 = time.time()
+        start = self.fromTimestamp(self.toTimestamp(t1), True)
+        last = dict((v, start) for v, jvar in jvars)
+        seen = dict((v, np.array([])) for v, jvar in jvars)
+        npoll = 0
+        while count is None or npoll < count:
+            if npoll > 0:
+                time.sleep(max(0, interval - (time.time() - tpoll)))
+            tpoll = time.time()
+            ts2 = self.toTimestamp(tpoll)
+            out = {}
+            for v, jvar in jvars:
+                ta = last[v] - lag
+                res = self._ts.getDataInTimeWindow(jvar, self.toTimestamp(ta),
+                                                   ts2)
+                ts, data = self.processDataset(
+                    res, res.getVariableDataType().toString(), True
+                )
+                new = (ts > last[v]) | ((ts > ta) & ~np.isin(ts, seen[v]))
+                if new.any():
+                    out[v] = ts[new], selectRecords(data, new)
+                    last[v] = max(last[v], ts[new].max())
+                    recent = np.union1d(seen[v], ts[new])
+                    seen[v] = recent[recent > last[v] - lag]
+            self._log.info('Retrieved new values for {0} variables'.format(
+                len(out)))
+            npoll += 1
+            yield out
+
     def getScaled(self, pattern_or_list, t1, t2, unixtime=True,
                   scaleAlgorithm='SUM', scaleInterval='MINUTE', scaleSize='1'):
         """Query the database for a list of variables or for variables whose
@@ -590,18 +1096,24 @@ class LoggingDB(object):
         if data is None:
             return None
         else:
+            modes = list(data.getBeamModes())
+            stamps = [data.getStartTime(), data.getEndTime()]
+            for mode in modes:
+                stamps.extend([mode.getStartTime(), mode.getEndTime()])
+            times = [None if ts is None else t for ts, t in
+                     zip(stamps, self.fromTimestamps(stamps, unixtime).tolist())]
             return {
                 'fillNumber': data.getFillNumber(),
-                'startTime': self.fromTimestamp(data.getStartTime(), unixtime),
-                'endTime': self.fromTimestamp(data.getEndTime(), unixtime),
+                'startTime': times[0],
+                'endTime': times[1],
                 'beamModes': [{
                     'mode':
                         mode.getBeamModeValue().toString(),
                     'startTime':
-                        self.fromTimestamp(mode.getStartTime(), unixtime),
+                        times[2 + 2 * i],
                     'endTime':
-                        self.fromTimestamp(mode.getEndTime(), unixtime)
-                } for mode in data.getBeamModes()]
+                        times[3 + 2 * i]
+                } for i, mode in enumerate(modes)]
             }
 
     def getLHCFillsByTime(self, t1, t2, beam_modes=None, unixtime=True):
@@ -666,32 +1178,83 @@ class LoggingDB(object):
         fills = self.getLHCFillsByTime(ts1, ts2, [mode1, mode2])
         out = []
         for fill in fills:
-            fn=fill['fillNumber']
-            m1=[]
-            m2=[]
-            for bm in fill['beamModes']:
-                if bm['mode'] == mode1:
-                    m1.append(bm[mode1time])
-                if bm['mode'] == mode2:
-                    m2.append(bm[mode2time])
-            if len(m1) > 0 and len(m2) > 0:
-                out.append([fn, m1[mode1idx], m2[mode2idx]])
+            interval = self._getFillInterval(fill, mode1, mode2,
+                                             mode1time, mode2time,
+                                             mode1idx, mode2idx)
+            if interval is not None:
+                out.append([fill['fillNumber']] + list(interval))
         return out
 
-    def getMetaData(self, pattern_or_list):
-        """Get All MetaData for a variable defined by a pattern_or_list"""
+    def _getFillInterval(self, fill, mode1, mode2,
+                         mode1time='startTime', mode2time='endTime',
+                         mode1idx=0, mode2idx=-1):
+        """Returns the interval (t1, t2) of a fill as returned by
+        getLHCFillData between beam modes mode1 and mode2, see
+        getIntervalsByLHCModes. If a mode is None the start or the end of
+        the fill is used. Returns None if a mode is not found.
+        """
+        m1 = []
+        m2 = []
+        for bm in fill['beamModes']:
+            if bm['mode'] == mode1:
+                m1.append(bm[mode1time])
+            if bm['mode'] == mode2:
+                m2.append(bm[mode2time])
+        if mode1 is None:
+            m1 = [fill['startTime']]
+        if mode2 is None:
+            m2 = [fill['endTime']]
+        if len(m1) > 0 and len(m2) > 0:
+            return m1[mode1idx], m2[mode2idx]
+
+    def getMetaData(self, pattern_or_list, refresh=False, asarray=False):
+        """Get All MetaData for a variable defined by a pattern_or_list.
+
+        Returns a dictionary {variable: (timestamps, names)}, where names[i]
+        is the array of vector element names valid from timestamps[i]. With
+        asarray=True, names is a 2-D array padded with '', see padNames.
+        The arrays are read-only.
+
+        The decoded metadata of the last 'metadatacache' variables is cached,
+        use refresh=True to query it again.
+        """
         out = {}
         variables = self.getVariablesList(pattern_or_list).getVariables()
         for variable in variables:
-            metadata = (self._md.getVectorElements(variable)
-                        .getVectornumericElements())
-            ts = [tt.fastTime / 1000 + tt.getNanos() / 1e9 for tt in metadata]
-            #            vv=[dict([(aa.key,aa.value) for aa in a.iterator()])
-            #                    for a in metadata.values()]
-            vv = [[aa.value for aa in a.iterator()] for a in metadata.values()]
-            out[variable.getVariableName()] = ts, vv
+            name = variable.getVariableName()
+            if not refresh and name in self._metadata:
+                decoded = self._metadata.pop(name)
+            else:
+                metadata = (self._md.getVectorElements(variable)
+                            .getVectornumericElements())
+                decoded = self._decodeMetaData(metadata)
+            self._metadata[name] = decoded
+            while len(self._metadata) > self.metadatacache:
+                self._metadata.popitem(last=False)
+            ts, names, rows = decoded
+            out[name] = ts, (names if asarray else rows)
         return out
 
+    def _decodeMetaData(self, metadata):
+        """Decode a map of vector elements into read-only arrays of the
+        timestamps and of the element names padded with '', and the tuple
+        of the element names of each timestamp as views of the latter."""
+        ts = self.fromTimestamps(list(metadata), True)
+        rows = [np.array(a.toArray(), dtype=str) for a in metadata.values()]
+        names = padNames(rows)
+        ts.setflags(write=False)
+        names.setflags(write=False)
+        rows = tuple(names[i, :len(row)] for i, row in enumerate(rows))
+        return ts, names, rows
+
+    def getMetaDataAt(self, variable, timestamps):
+        """Get the index of the metadata row of variable valid at each of
+        the given timestamps, -1 before the first metadata, and the 2-D
+        array of the element names of each row, see getMetaData and
+        metaDataIndex.
+        """
+        ts, names = self.getMetaData([variable], asarray=True)[variable]
+        return metaDataIndex(ts, timestamps), names
 
 class Hierarchy(object):
     def __init__(self, name, obj, src, varsrc):
@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import time
+import shutil
+import tempfile
+
+from numpy import *
+from pytimber.pagestore import PageStore
+
+def fill(db,npages,nvar):
+    """Insert the catalogue rows of npages pages of 10 records, without
+    writing page files"""
+    perpage=npages//nvar
+    rows=[]
+    for i in range(nvar):
+      varid=db.get_varid('var%04d'%i,create=True)
+      for j in range(perpage):
+        rows.append((i*perpage+j+1,varid,j*10,j*10+9))
+    sql="""INSERT INTO pages(pageid,varid,idxtype,count,idxa,idxb,
+              rectype,reclen,recsize) VALUES (?,?,'<i8',10,?,?,'<f8',0,80)"""
+    db.db.executemany(sql,rows)
+    db.db.commit()
+    return perpage
+
+def bench(sizes=(10**3,10**4,10**5,10**6),nvar=100,nquery=200):
+    for npages in sizes:
+      tmp=tempfile.mkdtemp()
+      try:
+        db=PageStore(tmp+'/bench.db',tmp+'/data')
+        perpage=fill(db,npages,nvar)
+        names=['var%04d'%i for i in random.randint(nvar,size=nquery)]
+        starts=random.randint(perpage*10,size=nquery)
+        timings=[]
+        for label,query in [
+            ('get_pages',lambda n,t: db.get_pages(n,t,t+50)),
+            ('get_lim',lambda n,t: db.get_lim(n)),
+            ('search',lambda n,t: db.search(n))]:
+          start=time.time()
+          for n,t in zip(names,starts):
+            query(n,int(t))
+          timings.append((time.time()-start)/nquery*1e3)
+        print("%8d pages: get_pages %8.3f ms, get_lim %8.3f ms, "
+              "search %8.3f ms"%((npages,)+tuple(timings)))
+      finally:
+        shutil.rmtree(tmp)
+
+if __name__=='__main__':
+    bench()
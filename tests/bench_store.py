@@ -0,0 +1,29 @@
+from __future__ import print_function
+
+import time
+import shutil
+import tempfile
+
+from numpy import *
+from pytimber.pagestore import PageStore
+
+def mkdata(nvar,nrec,t0):
+    idx=arange(t0,t0+nrec,dtype=float)
+    return dict(('var%04d'%i,(idx,random.rand(nrec))) for i in range(nvar))
+
+def bench(nvar=1000,nrec=100):
+    tmp=tempfile.mkdtemp()
+    try:
+      db=PageStore(tmp+'/bench.db',tmp+'/data')
+      for label,t0 in [('new pages',0),('append',nrec),('overlap',nrec/2)]:
+        data=mkdata(nvar,nrec,t0)
+        start=time.time()
+        db.store(data)
+        dt=time.time()-start
+        print("%-10s %5d variables: %7.3f s, %6.2f ms/variable"%(
+              label,nvar,dt,dt/nvar*1e3))
+    finally:
+      shutil.rmtree(tmp)
+
+if __name__=='__main__':
+    bench()
@@ -0,0 +1,68 @@
+"""Fake CALS services to test LoggingDB without a JVM"""
+import logging
+
+import pytimber.pytimber as pt
+from pytimber.pytimber import LoggingDB
+
+
+class FakeJpype(object):
+    def isThreadAttachedToJVM(self):
+        return 1
+
+
+class FakeVariable(object):
+    def __init__(self, name):
+        self.name = name
+
+    def getVariableName(self):
+        return self.name
+
+
+class FakeVariables(list):
+    def getVariable(self, name):
+        return FakeVariable(name)
+
+    def getVariables(self):
+        return [FakeVariable(name) for name in self]
+
+
+class FakeType(object):
+    def toString(self):
+        return 'NUMERIC'
+
+
+class FakeDataset(object):
+    def __init__(self, ts, values):
+        self.ts = ts
+        self.values = values
+
+    def getVariableDataType(self):
+        return FakeType()
+
+    def size(self):
+        return len(self.ts)
+
+
+class FakeTimeseries(object):
+    """Samples of each variable, the windows requested are recorded"""
+    def __init__(self, data):
+        self.data = data
+        self.windows = []
+
+    def getDataInTimeWindow(self, jvar, ts1, ts2):
+        self.windows.append((jvar.getVariableName(), ts1, ts2))
+        ts, values = self.data[jvar.getVariableName()]
+        mask = (ts >= ts1) & (ts <= ts2)
+        return FakeDataset(ts[mask], values[mask])
+
+
+def fake_db(data):
+    pt.jpype = FakeJpype()
+    db = LoggingDB.__new__(LoggingDB)
+    db._log = logging.getLogger('fakeldb')
+    db._ts = FakeTimeseries(data)
+    db.getVariablesList = lambda pattern: FakeVariables(sorted(data))
+    db.toTimestamp = db.fromTimestamp = lambda t, *args: t
+    db.toTimestamps = lambda values: list(values)
+    db.processDataset = lambda res, datatype, unixtime: (res.ts, res.values)
+    return db
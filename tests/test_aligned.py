@@ -0,0 +1,64 @@
+from numpy import *
+from numpy.random import *
+
+from pytimber.pagestore import PageStore
+
+def ref_align(master,idx,rec,how):
+    out=[]
+    for tt in master:
+      before=idx[idx<=tt]
+      after=idx[idx>=tt]
+      if how=='previous':
+        out.append(rec[len(before)-1] if len(before) else nan)
+      elif how=='nearest':
+        if len(after)==0 or len(before) and tt-before[-1]<=after[0]-tt:
+          out.append(rec[len(before)-1])
+        else:
+          out.append(rec[len(idx)-len(after)])
+      else:
+        if len(before)==0 or len(after)==0:
+          out.append(nan)
+        elif before[-1]==tt:
+          out.append(rec[len(before)-1])
+        else:
+          i=len(before)
+          w=(tt-idx[i-1])/(idx[i]-idx[i-1])
+          out.append(rec[i-1]*(1-w)+rec[i]*w)
+    return array(out)
+
+t={}
+t['m']=sort(unique(rand(500)*1000))
+t['a']=sort(unique(rand(300)*1000))
+t['b']=sort(unique(rand(50)*800+100))
+data=dict((name,(tt,rand(len(tt)))) for name,tt in t.items())
+
+db=PageStore('test_aligned.db','test_aligned',maxpagesize=400)
+try:
+  for i in range(0,500,37):
+    db.store(dict((name,(tt[i:i+37],vv[i:i+37]))
+                  for name,(tt,vv) in data.items() if len(tt[i:i+37])))
+  for idxa,idxb in [(None,None),(200,700),(950,2000)]:
+    for how in ['previous','nearest','interp']:
+      for nthreads in [1,4]:
+        db._cache.clear()
+        out=db.get_aligned(['m','a','b'],'m',idxa,idxb,how=how,
+                           nthreads=nthreads)
+        master,values=db.get_variable('m',idxa,idxb)
+        assert array_equal(out['timestamps'],master)
+        assert array_equal(out['m'],values)
+        for name in ['a','b']:
+          ref=ref_align(master,data[name][0],data[name][1],how)
+          assert allclose(out[name],ref,equal_nan=True)
+      idx,arr=db.get_aligned(['a','m','b'],'m',idxa,idxb,how=how,out='array')
+      assert array_equal(idx,out['timestamps'])
+      assert arr.shape==(len(idx),3)
+      assert allclose(arr[:,0],out['a'],equal_nan=True)
+  # vectors
+  db.store({'v':(t['a'],rand(len(t['a']),2))})
+  out=db.get_aligned(['m','v'],how='interp')
+  for col in range(2):
+    ref=ref_align(out['timestamps'],t['a'],db.get_variable('v')[1][:,col],
+                  'interp')
+    assert allclose(out['v'][:,col],ref,equal_nan=True)
+finally:
+  db.delete()
@@ -0,0 +1,30 @@
+from numpy import *
+
+from pytimber.pagestore import PageStore
+
+# results are writable and do not alias the cached pages
+db=PageStore('test_cache.db','test_cache',maxpagesize=800)
+try:
+  idx=arange(300.)
+  db.store({'v':(idx,idx*2),'w':(idx,[idx[:k%4+1] for k in range(300)])})
+  for k in range(3):
+    # miss, then hits of whole and cut pages
+    for idxa,idxb in [(None,None),(10,20)]:
+      for name in ('v','w'):
+        i,r=db.get_variable(name,idxa,idxb)
+        i[:]=-1
+        if name=='v':
+          r[:]=-1
+        else:
+          r[0][:]=-1
+      for name,i,r in db.iter_many(['v','w'],idxa,idxb):
+        i[:]=-1
+      d=db.get_aligned(['v'],idxa=idxa,idxb=idxb)
+      d['v'][:]=-1;d['timestamps'][:]=-1
+  assert db.cache_hits>0
+  i,r=db.get_variable('v')
+  assert (i==idx).all() and (r==idx*2).all()
+  i,r=db.get_variable('w')
+  assert (i==idx).all() and all([r[k][0]==0 for k in range(300)])
+finally:
+  db.delete()
@@ -0,0 +1,69 @@
+import os
+import gzip
+import shutil
+
+from numpy import *
+
+from pytimber import compression
+from pytimber.pagestore import PageStore
+from pytimber.page import Page
+
+# round trip of every available codec
+data=arange(10000.).tobytes()+b'abc'*100
+for name in compression.available():
+  assert compression.decompress(name,compression.compress(name,data))==data
+try:
+  compression.get_codec('nocodec')
+  assert False
+except ValueError:
+  pass
+
+# a registered codec is used for the pages of the store
+calls=[]
+def rev_compress(data):
+  calls.append('c')
+  return data[::-1]
+def rev_decompress(data):
+  calls.append('d')
+  return data[::-1]
+compression.register('rev',rev_compress,rev_decompress)
+idx=arange(100.);rec=idx*2
+db=PageStore('test_compression.db','test_compression',comp='rev',
+             checksum=True)
+try:
+  db.store({'v':(idx,rec)})
+  db._cache.clear()
+  i,r=db.get_variable('v',10,19)
+  assert (i==idx[10:20]).all() and (r==rec[10:20]).all()
+  assert calls==['c','d','d']
+finally:
+  db.delete()
+  del compression.codecs['rev']
+
+# pages gzipped by older versions, as .rec.gz or gunzipped in place as .rec
+# with comp still set to gzip
+for legacy in ['rec.gz','rec']:
+  db=PageStore('test_compression.db','test_compression')
+  try:
+    db.store({'v':(idx,rec)})
+    page=db.get_page(db.get_pages('v')[0][0])
+    assert os.path.exists(page.recpath)
+    if legacy=='rec.gz':
+      with open(page.recpath,'rb') as src:
+        with gzip.open(page.recpath+'.gz','wb') as dst:
+          shutil.copyfileobj(src,dst)
+      os.unlink(page.recpath)
+    with db.batch():
+      db.db.execute("UPDATE pages SET comp='gzip' WHERE pageid=?",
+                    [page.pageid])
+    ro=PageStore('test_compression.db','test_compression',checksum=True,
+                 readonly=True)
+    page=ro.get_page(page.pageid)
+    assert page.comp=='gzip' and page.check()
+    i,r=page.get(10,19)
+    assert (i==idx[10:20]).all() and (r==rec[10:20]).all()
+    i,r=ro.get_variable('v')
+    assert (i==idx).all() and (r==rec).all()
+    ro.close()
+  finally:
+    db.delete()
@@ -0,0 +1,97 @@
+import errno
+import multiprocessing
+import time
+
+from numpy import *
+
+from pytimber.pagestore import PageStore
+from pytimber.page import Page
+
+nstores=40;nrec=200
+
+def open_db():
+    return PageStore('test_concurrent.db','test_concurrent',maxpagesize=4000)
+
+def writer(name):
+    db=open_db()
+    # blocks stored in pairs out of order, to merge and rebalance pages
+    for k in range(nstores):
+      k^=1
+      idx=arange(k*nrec,(k+1)*nrec,dtype=float)
+      db.store({name:(idx,idx*2)})
+
+def check(idx,rec):
+    assert (rec==idx*2).all()
+    assert (diff(idx)>0).all()
+
+def reader(done):
+    db=open_db()
+    reads=0
+    while not done.is_set() or reads==0:
+      idx,rec=db.get_variable('w1')
+      check(idx,rec)
+      blocks=list(db.iter_variable('w2',chunk_records=150))
+      if blocks:
+        check(concatenate([i for i,r in blocks]),
+              concatenate([r for i,r in blocks]))
+      try:
+        with db.snapshot():
+          counts=[db.count(name) for name in ('w1','w2')]
+          data=db.get(['w1','w2'])
+      except (IOError,OSError) as e:
+        # without keep_deleted_pages the files of a snapshot can be removed
+        assert e.errno==errno.ENOENT
+        continue
+      for name,count in zip(('w1','w2'),counts):
+        check(*data[name])
+        assert len(data[name][0])==count
+      reads+=1
+
+if __name__=='__main__':
+  db=open_db()
+  try:
+    done=multiprocessing.Event()
+    writers=[multiprocessing.Process(target=writer,args=(name,))
+             for name in ('w1','w2')]
+    readers=[multiprocessing.Process(target=reader,args=(done,))
+             for i in range(3)]
+    for proc in writers+readers:
+      proc.start()
+    for proc in writers:
+      proc.join()
+    done.set()
+    for proc in readers:
+      proc.join()
+    assert all(proc.exitcode==0 for proc in writers+readers)
+    db.prune_delete_pages()
+    sql="SELECT COUNT(*) FROM pages WHERE deleted IS NOT NULL"
+    assert db.db.execute(sql).fetchone()[0]==0
+    for name in ('w1','w2'):
+      idx,rec=db.get_variable(name)
+      check(idx,rec)
+      assert (idx==arange(nstores*nrec)).all()
+    # writes are not allowed while reading a snapshot
+    with db.snapshot():
+      try:
+        db.store({'w1':([1e9],[2e9])})
+        assert False
+      except ValueError:
+        pass
+    # a store is opened and read without waiting for the lock of a writer
+    with db.batch():
+      db.store({'w1':([1e9],[2e9])})
+      start=time.time()
+      other=PageStore('test_concurrent.db','test_concurrent',timeout=0.5,
+                      retries=2)
+      assert time.time()-start<0.5
+      check(*other.get_variable('w1'))
+    # a page read before an append in place still matches its checksum
+    ck=PageStore('test_concurrent.db','test_concurrent',checksum=True)
+    ck.store({'c':(arange(10.),arange(10.))})
+    page=Page(ck.pagedir,*ck.get_pages('c')[0])
+    ck.store({'c':([10.],[10.])})
+    assert len(ck.get_pages('c'))==1 and ck.count('c')==11
+    assert page.check() and (page.get_all()[1]==arange(10.)).all()
+    assert Page(ck.pagedir,*ck.get_pages('c')[0]).check()
+  finally:
+    db.delete()
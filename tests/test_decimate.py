@@ -0,0 +1,26 @@
+from numpy import *
+from pytimber.decimate import *
+
+t=arange(100000.)
+v=sin(t/1000.)+random.rand(len(t))*0.1
+v[12345]=50; v[54321]=-50; v[500]=nan
+
+idx=minmax(t,v,1000)
+assert len(idx)<=1000
+assert 12345 in idx and 54321 in idx
+
+dec=MinMaxDecimator(t[0],t[-1],1000)
+for i in range(0,len(t),7777):
+  dec.add(t[i:i+7777],v[i:i+7777])
+tt,vv=dec.result()
+assert all(tt==t[idx])
+assert all(vv==v[idx])
+
+idx=lttb(t,v,1000)
+assert len(idx)==1000
+assert idx[0]==0 and idx[-1]==len(t)-1
+assert 12345 in idx and 54321 in idx
+assert all(diff(idx)>0)
+
+tt,vv=decimate(t[:10],v[:10],1000)
+assert len(tt)==10
@@ -0,0 +1,46 @@
+from numpy import *
+from pytimber.pytimber import narrowestDtype, narrowDtype
+
+def check(data,dtype):
+    data=array(data)
+    assert narrowestDtype(data)==dtype,(data,narrowestDtype(data),dtype)
+    # the result is the same when scanned in small chunks
+    assert narrowestDtype(data,chunksize=2)==dtype
+    out=narrowDtype(data)
+    assert out.dtype==dtype
+    assert array_equal(out,data,equal_nan=True)
+
+# integer valued floats
+check([0.,1.,-128.],int8)
+check([-1.,300.],int16)
+check([2.**24+1,0.],int32)        # not exact in float32
+check([2.**31,0.],float32)        # int64 is not smaller, float32 is exact
+check([2.**53+2,0.],float64)
+check([2.**63],float32)           # beyond int64
+
+# not finite values are kept, never narrowed to integers
+check([1.,nan],float32)
+check([1.,inf,-inf],float32)
+check([nan,nan],float32)
+check([0.1,nan],float64)
+
+# floats that are not exact in float32
+check([0.1],float64)
+check(array([0.1],dtype=float32),float32)
+
+# integers
+check(array([1,2],dtype=int64),int8)
+check(array([200],dtype=uint8),uint8)
+check(array([2**40],dtype=int64),int64)
+check(array([2**63],dtype=uint64),uint64)
+
+# empty and non numeric data are left unchanged
+check(array([],dtype=float64),float64)
+check(zeros((0,3)),float64)
+check(array([True,False]),bool_)
+check(array(['a','bc']),dtype('<U2'))
+assert narrowDtype([1.,2.])==[1.,2.]
+
+# vectors
+check([[1.,2.],[3.,nan]],float32)
+check([[1.,2.],[3.,4.]],int8)
@@ -0,0 +1,25 @@
+from numpy import *
+from pytimber.encoders import *
+
+def roundtrip(encode,decode,data):
+    out=decode(encode(data),data.dtype,len(data))
+    assert out.dtype==data.dtype
+    assert out.tobytes()==data.tobytes()
+
+imin,imax=iinfo(int64).min,iinfo(int64).max
+for data in [arange(100000)*0.1+1.6e9,
+             arange(1000)*1000000000+random.randint(0,10,1000),
+             array([imin,imax,0,-1,imax,imin],dtype=int64),
+             arange(300,dtype=uint8),arange(10,dtype=int32),
+             array([1.5]),array([],dtype=float),random.rand(1000)]:
+  roundtrip(encode_dod,decode_dod,data)
+
+for data in [cumsum(random.randn(10000)).round(2),random.rand(1000),
+             random.rand(1000).astype(float32),array([],dtype=float),
+             array([nan,inf,-inf,-0.,0.,1e-310,1.])]:
+  roundtrip(encode_xor,decode_xor,data)
+
+t=arange(10000)*0.5+1.6e9
+assert len(encode_dod(t))<len(t)+16
+assert len(encode_xor(zeros(1000)))==1000
+assert split_encoding(join_encoding('dod',None))==('dod',None)
@@ -0,0 +1,23 @@
+import time
+
+from numpy import *
+
+from fakeldb import fake_db
+
+# an ongoing fill is read up to now, not replaced by the last sample
+# before its start
+now = time.time()
+ts = array([now - 100, now - 50, now - 10])
+db = fake_db({'v': (ts, ts * 2)})
+fills = {1: {'startTime': now - 60, 'endTime': None, 'beamModes': []},
+         2: {'startTime': now - 120, 'endTime': now - 80, 'beamModes': []}}
+db.getLHCFillData = lambda fill: fills[fill]
+out = db.getByFills('v', [1, 2])
+assert list(out[1]['v'][0]) == [now - 50, now - 10]
+assert list(out[2]['v'][0]) == [now - 100]
+for jvar, ts1, ts2 in db._ts.windows:
+    assert ts2 is not None and ts2 >= ts1
+# windows given directly can be open too
+out = db.getByFills('v', [(3, now - 20, None)])
+assert list(out[3]['v'][1]) == [2 * (now - 10)]
+
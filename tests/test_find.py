@@ -0,0 +1,51 @@
+from numpy import *
+from numpy.random import *
+
+from pytimber.pagestore import PageStore, match_records
+from pytimber.localstats import getStats
+
+t=arange(5000.)
+v=sin(t/300.)
+v[[7,2500]]=nan
+m=rand(len(t),3)
+l=[rand(randint(1,4)) for i in range(len(t))]
+
+db=PageStore('test_find.db','test_find',maxpagesize=2000)
+try:
+  for i in range(0,len(t),100):
+    db.store({'v':(t[i:i+100],v[i:i+100]),'m':(t[i:i+100],m[i:i+100]),
+              'l':(t[i:i+100],l[i:i+100])})
+  # summaries kept by in place appends
+  assert db.get_pages('v')[-1][2]>100
+  for name in ['v','m']:
+    for idxa,idxb in [(None,None),(123.,4567.),(20.,20.)]:
+      st=db.stats(name,idxa,idxb)
+      ref=getStats(db.get(name,idxa,idxb))[name]
+      assert st.ValueCount==ref.ValueCount
+      assert allclose(st,ref)
+  st=db.stats('l')
+  values=concatenate(l)
+  assert st.ValueCount==len(values) and st.MaxValue==values.max()
+  assert allclose(st.AvgValue,values.mean())
+  # pages without NaN are not read
+  db._cache.clear();db.cache_misses=0
+  db.stats('v',3100,None)
+  assert db.cache_misses==1
+  # find
+  for pred in [('>',0.9),('>=',-1),('<',-0.5),('<=',2),('==',v[42]),
+               ('!=',v[42]),('>',5)]:
+    for name,data in [('v',v),('m',m)]:
+      for idxa,idxb in [(None,None),(1000,4000)]:
+        idx=db.find(name,pred,idxa,idxb)
+        ref=db.get(name,idxa,idxb)[name]
+        assert array_equal(idx,ref[0][match_records(ref[1],pred)])
+  idx=db.find('l',('>',0.99))
+  assert array_equal(idx,[tt for tt,ll in zip(t,l) if (ll>0.99).any()])
+  idx=db.find('v',lambda rec: abs(rec)<1e-3)
+  assert array_equal(idx,t[abs(v)<1e-3])
+  assert array_equal(db.find('v',('>',0.99),limit=3),t[v>0.99][:3])
+  db._cache.clear();db.cache_misses=0
+  assert len(db.find('v',('>',5)))==0
+  assert db.cache_misses==2 # pages with NaN
+finally:
+  db.delete()
@@ -0,0 +1,30 @@
+import time
+
+from numpy import *
+from pytimber.pytimber import selectRecords
+from fakeldb import fake_db
+
+# records selected by follow from arrays and from lists of records
+mask=array([True,False,True])
+assert list(selectRecords(array([1.,2.,3.]),mask))==[1.,3.]
+assert selectRecords(['a','bc','def'],mask)==['a','def']
+vec=[array([1.]),array([1.,2.]),array([1.,2.,3.])]
+out=selectRecords(vec,mask)
+assert len(out)==2 and list(out[1])==[1.,2.,3.]
+assert selectRecords([],zeros(0,dtype=bool))==[]
+
+# follow requests only the recent data and merges the samples arriving
+# late behind the last one seen, within one interval by default
+now=time.time()
+store={'v':(array([now-0.8]),array([0.]))}
+db=fake_db(store)
+polls=db.follow('v',t1=now-1,interval=0.5,count=3)
+delta=next(polls)
+assert list(delta['v'][1])==[0.]
+store['v']=(array([now-0.8,now-0.4,now]),array([0.,1.,2.]))
+delta=next(polls)
+assert list(delta['v'][1])==[1.,2.]
+store['v']=(array([now-0.8,now-0.4,now-0.3,now]),array([0.,1.,5.,2.]))
+delta=next(polls)
+assert list(delta['v'][1])==[5.]
+assert all(ts1>=now-1.5 for name,ts1,ts2 in db._ts.windows[1:])
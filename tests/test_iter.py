@@ -0,0 +1,49 @@
+from numpy import *
+from numpy.random import *
+
+from pytimber.pagestore import PageStore, concatenate
+from dictdb import check_data
+
+def mkrec(kind,n):
+    if kind=='scalar':
+      return rand(n)
+    elif kind=='vector':
+      return rand(n,3)
+    else:
+      return [rand(randint(1,5)) for i in range(n)]
+
+def join(blocks):
+    idx,rec=zip(*blocks)
+    return concatenate(idx),concatenate(rec)
+
+db=PageStore('test_iter.db','test_iter',maxpagesize=400)
+try:
+  for kind in ['scalar','vector','varlen']:
+    for k in range(20):
+      idx=arange(k*10,k*10+10.)
+      db.store({kind:(idx,mkrec(kind,len(idx)))})
+  for kind in ['scalar','vector','varlen']:
+    for idxa,idxb in [(None,None),(15.5,150),(3,3),(500,600)]:
+      ref=db.get(kind,idxa,idxb)
+      for chunk_records in [None,1,7,1000]:
+        for readahead in [True,False]:
+          db._cache.clear()
+          blocks=list(db.iter_variable(kind,idxa,idxb,
+                                       chunk_records,readahead))
+          assert all(len(idx)>0 for idx,rec in blocks)
+          if chunk_records is not None:
+            assert all(len(idx)==chunk_records for idx,rec in blocks[:-1])
+          if len(ref[kind][0])==0:
+            assert blocks==[]
+          else:
+            assert check_data(ref,{kind:join(blocks)})
+  # several variables one after the other
+  blocks=list(db.iter_many('%',20,60,chunk_records=15))
+  names=[name for name,idx,rec in blocks]
+  groups=[nn for ii,nn in enumerate(names) if ii==0 or names[ii-1]!=nn]
+  assert len(groups)==len(set(groups))==3
+  for name in set(names):
+    data=join([(idx,rec) for nn,idx,rec in blocks if nn==name])
+    assert check_data(db.get(name,20,60),{name:data})
+finally:
+  db.delete()
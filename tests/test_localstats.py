@@ -0,0 +1,32 @@
+from numpy import *
+from pytimber.localstats import *
+from pytimber.pagestore import PageStore
+
+t=arange(10000.)
+v=1e9+random.randn(len(t))
+
+acc=StatAccumulator()
+for i in range(0,len(t),777):
+  acc.merge(StatAccumulator().add(t[i:i+777],v[i:i+777]))
+st=acc.stat()
+assert st.ValueCount==len(v)
+assert st.MinTstamp==t[0] and st.MaxTstamp==t[-1]
+assert st.MinValue==v.min() and st.MaxValue==v.max()
+assert abs(st.AvgValue-v.mean())<1e-6
+assert abs(st.StandardDeviationValue-v.std(ddof=1))<1e-6
+
+v[[0,10,9999]]=nan
+st=getStats({'v':(t,v)})['v']
+assert st.ValueCount==len(v)-3
+assert st.MinTstamp==1 and st.MaxTstamp==9998
+
+db=PageStore('test_localstats.db','test_localstats',maxpagesize=1000)
+try:
+  db.store({'v':(t,v)})
+  for idxa,idxb in [(None,None),(123.,4567.),(20.,20.)]:
+    st=db.stats('v',idxa,idxb)
+    ref=getStats(db.get('v',idxa,idxb))['v']
+    assert st.ValueCount==ref.ValueCount
+    assert allclose(st,ref)
+finally:
+  db.delete()
@@ -0,0 +1,38 @@
+from numpy import *
+from numpy.random import *
+
+from pytimber.pagestore import PageStore, merge
+from dictdb import DictDB, check_data
+
+def mkrec(kind,n):
+    if kind=='scalar':
+      return rand(n)
+    elif kind=='vector':
+      return rand(n,3)
+    else:
+      return [rand(randint(1,5)) for i in range(n)]
+
+def mkidx(n):
+    return sort(randint(100,size=n)).astype(float)
+
+for kind in ['scalar','vector','varlen']:
+  for n in range(50):
+    idx0=unique(mkidx(randint(1,30)));rec0=mkrec(kind,len(idx0))
+    idx1=mkidx(randint(1,30));rec1=mkrec(kind,len(idx1))
+    a=DictDB()
+    a.store({'v':(idx0,rec0)})
+    a.store({'v':(idx1,rec1)})
+    assert check_data(a.get(),{'v':merge(idx0,rec0,idx1,rec1)})
+
+b=PageStore('test_merge.db','test_merge',maxpagesize=1000)
+try:
+  a=DictDB()
+  for n in range(30):
+    kind=['scalar','vector','varlen'][n%3]
+    idx=unique(mkidx(randint(1,50)))
+    data={kind:(idx,mkrec(kind,len(idx)))}
+    a.store(data)
+    b.store(data)
+    assert check_data(a.get(),b.get('%'))
+finally:
+  b.delete()
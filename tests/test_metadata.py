@@ -0,0 +1,56 @@
+from numpy import *
+from collections import OrderedDict
+
+from pytimber.pytimber import padNames, metaDataAt, metaDataIndex
+from fakeldb import fake_db, FakeVariables
+
+ts=array([10.,20.,30.])
+rows=[['a','b'],['a','b','cc'],['d']]
+
+names=padNames(rows)
+assert names.shape==(3,3)
+assert list(names[0])==['a','b',''] and list(names[2])==['d','','']
+assert padNames([]).shape==(0,0)
+
+# timestamps before the first metadata give None, not the last row
+out=metaDataAt(ts,rows,[5.,10.,15.,30.,99.])
+assert out==[None,rows[0],rows[0],rows[2],rows[2]]
+assert metaDataAt(ts,rows,25.)==[rows[1]]
+assert metaDataAt([],[],[1.])==[None]
+assert list(metaDataIndex(ts,[5.,10.,25.,99.]))==[-1,0,1,2]
+
+class FakeTimestamp(object):
+    def __init__(self,t):
+        self.fastTime=int(t*1000)
+    def getNanos(self):
+        return 0
+
+class FakeElements(object):
+    def __init__(self,names):
+        self.names=names
+    def toArray(self):
+        return self.names
+
+class FakeMetaData(object):
+    """Vector element names of variable 'bpm', the queries are counted"""
+    queries=0
+    def getVectorElements(self,variable):
+        self.queries+=1
+        return self
+    def getVectornumericElements(self):
+        return OrderedDict((FakeTimestamp(t),FakeElements(row))
+                           for t,row in zip(ts,rows))
+
+db=fake_db({})
+db._md=FakeMetaData()
+db._metadata=OrderedDict()
+db.getVariablesList=lambda pattern: FakeVariables(['bpm'])
+mts,mrows=db.getMetaData('bpm')['bpm']
+assert list(mts)==list(ts) and [list(row) for row in mrows]==rows
+mts,names=db.getMetaData('bpm',asarray=True)['bpm']
+assert (names==padNames(rows)).all() and not names.flags.writeable
+assert db._md.queries==1
+idx,names=db.getMetaDataAt('bpm',[5.,20.,31.])
+assert list(idx)==[-1,1,2] and list(names[idx[1]])==['a','b','cc']
+db.getMetaData('bpm',refresh=True)
+assert db._md.queries==2
@@ -0,0 +1,69 @@
+import sqlite3
+
+from numpy import *
+from pytimber.pagestore import PageStore
+from pytimber.page import Page
+
+# database with the schema of version 0, idxa/idxb of page 2 stored as blobs
+db=sqlite3.connect('test_migrate.db')
+db.executescript("""
+CREATE TABLE pages(name STRING, pageid INTEGER, idxtype STRING,
+  count INTEGER, idxa NUMERIC, idxb NUMERIC, rectype STRING,
+  reclen INTEGER, recsize INTEGER, comp STRING, created NUMERIC,
+  checksum STRING, deleted NUMERIC);
+CREATE INDEX page_index ON pages(pageid);""")
+for pageid,name,idx in [(1,'a',arange(10.)),(2,'b',arange(20))]:
+  page=Page.from_data(idx,idx*2,'test_migrate',pageid)
+  row=[name]+page._tolist()[:11]+[None]
+  if pageid==2:
+    row[4:6]=[idx[0].tobytes(),idx[-1].tobytes()]
+  db.execute("INSERT INTO pages VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",row)
+db.commit()
+db.close()
+
+db=PageStore('test_migrate.db','test_migrate')
+try:
+  assert db.db.execute("PRAGMA user_version").fetchone()[0]==1
+  assert sorted(db.search('%'))==['a','b']
+  idx,rec=db.get_variable('b',5,7)
+  assert list(idx)==[5,6,7] and list(rec)==[10,12,14]
+  assert db.get_lim('a')==(0,9)
+  db.store({'b':(arange(15,25),arange(10))})
+  assert db.count('b')==25
+finally:
+  db.delete()
+
+# a failing migration leaves the database unchanged
+def make_v0(idxb):
+  db=sqlite3.connect('test_migrate.db')
+  db.executescript("""
+  CREATE TABLE pages(name STRING, pageid INTEGER, idxtype STRING,
+    count INTEGER, idxa NUMERIC, idxb NUMERIC, rectype STRING,
+    reclen INTEGER, recsize INTEGER, comp STRING, created NUMERIC,
+    checksum STRING, deleted NUMERIC);""")
+  idx=arange(10.)
+  page=Page.from_data(idx,idx*2,'test_migrate',1)
+  row=['a']+page._tolist()[:11]+[None]
+  row[5]=idxb
+  db.execute("INSERT INTO pages VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",row)
+  db.commit()
+  return db
+
+raw=make_v0(b'\x00\x01\x02')
+try:
+  try:
+    PageStore('test_migrate.db','test_migrate')
+    assert False
+  except ValueError:
+    pass
+  assert raw.execute("PRAGMA user_version").fetchone()[0]==0
+  tables=raw.execute("SELECT name FROM sqlite_master WHERE type='table'")
+  assert [row[0] for row in tables]==['pages']
+  assert raw.execute("SELECT COUNT(*) FROM pages").fetchone()[0]==1
+  raw.execute("UPDATE pages SET idxb=?",[arange(10.)[-1:].tobytes()])
+  raw.commit()
+  db=PageStore('test_migrate.db','test_migrate')
+  assert db.search('%')==['a'] and db.get_lim('a')==(0,9)
+finally:
+  raw.close()
+  db.delete()
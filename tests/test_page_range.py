@@ -0,0 +1,57 @@
+import os
+import shutil
+
+from numpy import *
+
+import pytimber.page
+from pytimber.page import Page
+
+def makedata(nrec,lrec,lrecr):
+  idx=arange(nrec*1.0)
+  val=[random.rand(lrec+int(random.rand()*lrecr)) for i in idx]
+  return idx,val
+
+def mkrange(idx,rec):
+    p=Page.from_data(idx,rec,'.',0)
+    try:
+      aidx,arec=p.get_all()
+      for idxa,idxb in [(-5,3),(10,10),(20,30.5),(35,200),(200,300),(3,2)]:
+        a=aidx.searchsorted(idxa,side='left')
+        b=aidx.searchsorted(idxb,side='right')
+        nidx,nrec=p.get(idxa,idxb)
+        assert list(nidx)==list(aidx[a:b])
+        assert len(nrec)==b-a
+        for av,bv in zip(nrec,arec[a:b]):
+          assert all(av==bv)
+        assert p.get_count(idxa,idxb)==b-a
+    finally:
+      p.delete()
+
+mkrange(arange(40.), random.rand(40,3))
+mkrange(arange(40.), random.rand(40))
+mkrange(*makedata(40,5,10))
+
+# point lookups in large pages read only the matching records
+read=[]
+def read_range(fname,dtype,start,count,offset=0):
+    out=orig_read_range(fname,dtype,start,count,offset)
+    read.append(out.nbytes)
+    return out
+orig_read_range=pytimber.page.read_range
+pytimber.page.read_range=read_range
+os.mkdir('test_page_range')
+try:
+  n=2**20
+  for idx,rec in [(arange(n*1.),arange(n*2.).reshape(n,2)),
+                  (arange(n/16.),[arange(k%7*1.) for k in range(n//16)])]:
+    p=Page.from_data(idx,rec,'test_page_range',0)
+    p.get_all=None
+    del read[:]
+    i,r=p.get(1000.5,1002)
+    assert list(i)==[1001.,1002.]
+    assert all(r[0]==rec[1001]) and all(r[1]==rec[1002])
+    assert 0<sum(read)<=4096
+    p.delete()
+finally:
+  pytimber.page.read_range=orig_read_range
+  shutil.rmtree('test_page_range')
@@ -0,0 +1,82 @@
+import os
+import shutil
+import time
+import sqlite3
+import warnings
+
+from numpy import *
+from pytimber.pagestore import PageStore
+from pytimber.page import Page
+
+def open_time(dbname,pagedir):
+    out=[]
+    for i in range(5):
+      start=time.time()
+      db=PageStore(dbname,pagedir,readonly=True)
+      out.append(time.time()-start)
+      db.close()
+    return min(out)
+
+idx=arange(1000.);rec=idx*2
+db=PageStore('test_readonly.db','test_readonly')
+try:
+  db.store({'v':(idx[:500],rec[:500])})
+  small=open_time('test_readonly.db','test_readonly')
+  # about 64 MB of pages marked as deleted
+  sql="""INSERT INTO pages(pageid,varid,idxtype,count,checksum,deleted)
+         SELECT pageid+(SELECT MAX(pageid) FROM pages),varid,idxtype,count,
+         hex(randomblob(100)),1 FROM pages"""
+  with db.batch():
+    for k in range(19):
+      db.db.execute(sql)
+  assert os.path.getsize('test_readonly.db')>2**26
+  large=open_time('test_readonly.db','test_readonly')
+  print("read-only open: %.2f ms small, %.2f ms large"%(small*1e3,large*1e3))
+  assert large<max([5*small,0.01])
+
+  # the database is read in place, without writes
+  ro=PageStore('test_readonly.db','test_readonly',readonly=True)
+  assert ro._tmpcopy is None
+  i,r=ro.get_variable('v')
+  assert (i==idx[:500]).all() and (r==rec[:500]).all()
+  db.store({'v':(idx[500:],rec[500:])})
+  i,r=ro.get_variable('v')
+  assert (i==idx).all() and (r==rec).all()
+  for write in (lambda: ro.store({'v':([2000.],[1.])}),
+                lambda: ro.set_comp('v','zlib'),
+                ro.delete):
+    try:
+      write()
+      assert False
+    except ValueError:
+      pass
+  ro.close()
+finally:
+  db.delete()
+
+# a database with an older schema is migrated in a temporary copy
+old=sqlite3.connect('test_readonly.db')
+old.executescript("""
+CREATE TABLE pages(name STRING, pageid INTEGER, idxtype STRING,
+  count INTEGER, idxa NUMERIC, idxb NUMERIC, rectype STRING,
+  reclen INTEGER, recsize INTEGER, comp STRING, created NUMERIC,
+  checksum STRING, deleted NUMERIC);""")
+page=Page.from_data(idx,rec,'test_readonly',1)
+old.execute("INSERT INTO pages VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            ['v']+page._tolist()[:11]+[None])
+old.commit()
+try:
+  with warnings.catch_warnings(record=True) as caught:
+    warnings.simplefilter('always')
+    ro=PageStore('test_readonly.db','test_readonly',readonly=True)
+  assert len(caught)==1
+  i,r=ro.get_variable('v',10,19)
+  assert (i==idx[10:20]).all() and (r==rec[10:20]).all()
+  assert old.execute("PRAGMA user_version").fetchone()[0]==0
+  tmpcopy=ro._tmpcopy
+  ro.close()
+  assert not os.path.exists(tmpcopy)
+finally:
+  old.close()
+  os.unlink('test_readonly.db')
+  shutil.rmtree('test_readonly')
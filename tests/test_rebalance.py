@@ -0,0 +1,62 @@
+from numpy import *
+
+from pytimber.pagestore import PageStore
+
+def count_pages(db,variable):
+    return len(db.get_pages(variable))
+
+idx=arange(2000.);rec=random.rand(2000)
+
+# stores in reverse order are merged with their neighbours only
+db=PageStore('test_rebalance.db','test_rebalance',maxpagesize=800)
+try:
+  for k in range(99,-1,-1):
+    db.store({'v':(idx[k*20:k*20+20],rec[k*20:k*20+20])})
+    db.store({'v2':(idx[k*20:k*20+20],rec[k*20:k*20+20])})
+  for name in ['v','v2']:
+    i,r=db.get(name)[name]
+    assert (i==idx).all() and (r==rec).all()
+    assert count_pages(db,name)==20
+finally:
+  db.delete()
+
+# compact rebalances the whole history
+db=PageStore('test_rebalance.db','test_rebalance',maxpagesize=0)
+try:
+  for k in range(99,-1,-1):
+    db.store({'v':(idx[k*20:k*20+20],rec[k*20:k*20+20])})
+  assert count_pages(db,'v')==100
+  done=[]
+  db.compact(maxpagesize=800,progress=lambda *args: done.append(args))
+  assert done==[(1,1,'v')]
+  assert count_pages(db,'v')==20
+  i,r=db.get('v')['v']
+  assert (i==idx).all() and (r==rec).all()
+finally:
+  db.delete()
+
+# pages that cannot grow in place are merged with the new records
+for comp,encoding in [(None,None),('zlib',None),(None,'dod,'),
+                      (None,'dod,xor'),('zlib','dod,xor')]:
+  db=PageStore('test_rebalance.db','test_rebalance',maxpagesize=8000,
+               comp=comp,encoding=encoding)
+  try:
+    for k in range(200):
+      db.store({'v':(idx[k*10:k*10+10],rec[k*10:k*10+10])})
+    assert count_pages(db,'v')==2
+    i,r=db.get('v')['v']
+    assert (i==idx).all() and (r==rec).all()
+  finally:
+    db.delete()
+
+# variable length records
+db=PageStore('test_rebalance.db','test_rebalance',maxpagesize=8000)
+try:
+  vrec=[rec[:k%10+1] for k in range(2000)]
+  for k in range(200):
+    db.store({'v':(idx[k*10:k*10+10],vrec[k*10:k*10+10])})
+  assert count_pages(db,'v')<=sum([len(r) for r in vrec])*8//8000+2
+  i,r=db.get('v')['v']
+  assert (i==idx).all() and all([(a==b).all() for a,b in zip(r,vrec)])
+finally:
+  db.delete()
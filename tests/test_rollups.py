@@ -0,0 +1,83 @@
+from numpy import *
+from numpy.random import *
+
+from pytimber.pagestore import PageStore
+from pytimber.page import Page
+from pytimber.decimate import rollup
+
+t=arange(0,20000,0.5)
+v=randn(len(t))
+v[[10,5000,5001]]=nan
+
+def check_rollups(db,name,t,v):
+    for width in [60,3600]:
+      idx,rec=db.get_variable('%s@%d'%(name,width))
+      ridx,rrec=rollup(t,v,width)
+      assert array_equal(idx,ridx)
+      assert allclose(rec,rrec,equal_nan=True)
+
+# rollups of the finest level agree with direct computation
+tt,vv=rollup(t,v,60)
+tt,vv=rollup(tt,vv,3600)
+assert allclose(vv,rollup(t,v,3600)[1])
+
+db=PageStore('test_rollups.db','test_rollups',maxpagesize=4000,
+             rollups=[60,3600])
+try:
+  # appends of chunks not aligned to the buckets
+  for i in range(0,len(t),777):
+    db.store({'v':(t[i:i+777],v[i:i+777])})
+  check_rollups(db,'v',t,v)
+  # rewriting old data updates the buckets
+  v[1000:1300]=rand(300)
+  db.store({'v':(t[1000:1300],v[1000:1300])})
+  check_rollups(db,'v',t,v)
+  # the open bucket has a page of its own, replaced by each store
+  pages=[Page(db.pagedir,*res) for res in db.get_pages('v@60')]
+  assert pages[-1].count==1 and len(pages)<=4
+  # rollups are not listed
+  assert db.search('%')==['v']
+  assert [w for w,n in db.get_rollups('v')]==[60,3600]
+  # choice of the resolution
+  idx,rec=db.get_variable('v',maxpoints=len(t))
+  assert rec.ndim==1 and len(rec)==len(t)
+  idx,rec=db.get_variable('v',maxpoints=1000)
+  assert rec.shape==(334,4)
+  idx,rec=db.get_variable('v',1000,8000,maxpoints=20)
+  assert rec.shape==(3,4) and idx[0]==0
+  idx,rec=db.get_variable('v',resolution=100)
+  assert rec.shape==(334,4)
+  assert db.get_variable('v',resolution=10)[1].ndim==1
+  # non numeric variables have no rollups
+  db.store({'m':(t[:10],rand(10,2))})
+  assert db.get_rollups('m')==[]
+  db.delete_variable('v')
+  assert db.get_variable('v@60')[0].size==0
+  # records are never replaced in place: another connection sees the
+  # committed records and checksums while a batch replaces the last one
+  wr=PageStore('test_rollups.db','test_rollups',checksum=True,
+               rollups=[60,3600])
+  rd=PageStore('test_rollups.db','test_rollups')
+  wr.store({'r':(arange(10.),arange(10.))})
+  with rd.snapshot():
+    pages=[Page(rd.pagedir,*res)
+           for name in ('r','r@60') for res in rd.get_pages(name)]
+    try:
+      with wr.batch():
+        wr.store({'r':([9.,10.],[99.,-1.])})
+        assert array_equal(rd.get_variable('r')[1],arange(10.))
+        assert all(page.check() for page in pages)
+        raise RuntimeError
+    except RuntimeError:
+      pass
+  assert array_equal(rd.get_variable('r')[1],arange(10.))
+  assert rd.stats('r').MaxValue==9
+  wr.store({'r':([9.,10.],[99.,-1.])})
+  assert array_equal(rd.get_variable('r')[1],r_[arange(9.),99.,-1.])
+  check_rollups(rd,'r',arange(11.),r_[arange(9.),99.,-1.])
+  # the pages keep their summary
+  assert all(Page(rd.pagedir,*res).vmin is not None
+             for res in rd.get_pages('r'))
+  assert rd.stats('r').MaxValue==99
+finally:
+  db.delete()
@@ -0,0 +1,76 @@
+import os
+
+from numpy import *
+from numpy.random import *
+
+from pytimber.pagestore import PageStore
+from dictdb import DictDB, check_data
+
+def mkrec(kind,n):
+    if kind=='scalar':
+      return rand(n)
+    elif kind=='vector':
+      return rand(n,3)
+    else:
+      return [rand(randint(1,5)) for i in range(n)]
+
+def mkidx(n):
+    return sort(randint(100,size=n)).astype(float)
+
+def count_files(path):
+    return len([fname for _,_,files in os.walk(path) for fname in files])
+
+def segments_size(db):
+    return sum([os.path.getsize(f) for f in db._segment_files().values()])
+
+# random stores in segments give the same data as in memory
+for comp,encoding in [(None,None),('zlib','dod,xor')]:
+  b=PageStore('test_segments.db','test_segments',maxpagesize=1000,
+              checksum=comp is not None,segmentsize=4000,comp=comp,encoding=encoding)
+  try:
+    a=DictDB()
+    for n in range(60):
+      kind=['scalar','vector','varlen'][n%3]
+      idx=unique(mkidx(randint(1,50)))
+      data={kind:(idx,mkrec(kind,len(idx)))}
+      a.store(data)
+      b.store(data)
+      b._cache.clear()
+      assert check_data(a.get(),b.get('%'))
+    for kind in ['scalar','vector','varlen']:
+      assert check_data({kind:a.get()[kind]},{kind:b.get(kind)[kind]})
+      idxa,idxb=30,60
+      idx,rec=a.get()[kind]
+      sel=(idx>=idxa)&(idx<=idxb)
+      b._cache.clear()
+      ref={kind:(idx[sel],[r for r,s in zip(rec,sel) if s])}
+      assert check_data(ref,b.get(kind,idxa,idxb))
+    # pages share a few segment files
+    assert count_files(b.pagedir)==len(b._segment_files())
+    # compaction keeps the data and removes the emptied segments
+    before=segments_size(b)
+    reclaimed=b.compact_segments()
+    after=segments_size(b)
+    assert reclaimed>0 and after<before
+    b._cache.clear()
+    assert check_data(a.get(),b.get('%'))
+  finally:
+    b.delete()
+
+# a failed batch leaves the segment as it was
+b=PageStore('test_segments.db','test_segments',segmentsize=2**20)
+try:
+  b.store({'v':(arange(10.),rand(10))})
+  fname=b._segment_files()[0]
+  size=os.path.getsize(fname)
+  try:
+    with b.batch():
+      b.store({'v':(arange(10.,20.),rand(10))})
+      b.store({'w':(arange(10.),rand(10))})
+      raise KeyboardInterrupt
+  except KeyboardInterrupt:
+    pass
+  assert os.path.getsize(fname)==size
+  assert len(b.get('v')['v'][0])==10
+finally:
+  b.delete()
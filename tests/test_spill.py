@@ -0,0 +1,51 @@
+import os
+import gc
+import shutil
+import tempfile
+
+from numpy import *
+
+import pytimber.pytimber as pt
+from fakeldb import fake_db
+
+
+class LockedOs(object):
+    """os, but mapped files cannot be unlinked while locked is True, as on
+    Windows"""
+    locked = True
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def unlink(self, path):
+        if self.locked:
+            raise OSError('file in use')
+        os.unlink(path)
+
+
+db = fake_db({})
+tmp = tempfile.mkdtemp()
+try:
+    # dtype conversions are counted in the budget
+    spill = {'budget': 100, 'dir': tmp}
+    out = db.applyDtype('v', arange(10.), 'auto', spill)
+    assert out.dtype == int8 and spill['budget'] == 90
+    out = db.applyDtype('v', arange(100.), float32, spill)
+    assert isinstance(out, memmap) and spill['budget'] == 90
+    assert (out == arange(100.)).all()
+    assert os.listdir(tmp) == []
+    # files that cannot be removed while mapped are removed when released
+    pt.os = LockedOs()
+    out = db._allocate((100,), float64, spill)
+    view = out[10:20]
+    assert len(os.listdir(tmp)) == 1
+    pt.os.locked = False
+    del out
+    gc.collect()
+    assert len(os.listdir(tmp)) == 1
+    del view
+    gc.collect()
+    assert os.listdir(tmp) == []
+finally:
+    pt.os = os
+    shutil.rmtree(tmp)